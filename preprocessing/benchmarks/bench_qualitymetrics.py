@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+# include parent dir
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from projections.projection import Projection
+from projections.qualitymetrics import calculate_distance_matrix, get_graph_from_fire_data, \
+    wrapper_for_d_matrix_calculation, points_ordering_to_wildfire_structure, calculate_M1, calculate_M2, \
+    calculate_M1_M2, calculate_metric_stress, calculate_nonmetric_stress, DistanceMatrix, LinearDistanceMatrix
+
+
+logging.basicConfig(format='%(asctime)s %(levelname)8s  %(message)s',
+        level=logging.INFO,
+        datefmt='%H:%M:%S')
+
+
+DEFAULT_SIZES = [100, 1000, 5000, 10000, 50000]
+
+
+def synthetic_data(n, seed):
+    '''
+    A point cloud of `n` points in a 1000km square (as EPSG3857 coordinates
+    would be), and a random ordering of it.
+    '''
+    rng = np.random.RandomState(seed)
+    points = rng.rand(n, 2) * 1e6
+    ordering = rng.permutation(n)
+
+    return points, ordering
+
+
+def _dense_distances(points, ordering, k):
+    d_org = DistanceMatrix.from_array(points).distance_matrix
+    d_proj = np.abs(ordering[:, np.newaxis] - ordering[np.newaxis, :]).astype(float)
+
+    return d_org / np.max(d_org), d_proj / np.max(d_proj)
+
+
+def _graphs(points, ordering, k):
+    data, data_proj = points_ordering_to_wildfire_structure(points, ordering)
+
+    return get_graph_from_fire_data(data, k), get_graph_from_fire_data(data_proj, k), \
+        wrapper_for_d_matrix_calculation(data), wrapper_for_d_matrix_calculation(data_proj), k
+
+
+# name -> (needs an N×N matrix, setup(points, ordering, k) -> args, function(*args))
+#
+# Only the function is timed. The setup runs before every repetition, so that
+# no lazily computed state (e.g., rank matrices) is carried over.
+BENCHMARKS = {
+    'calculate_distance_matrix': (True,
+        lambda points, ordering, k: (pd.DataFrame(dict(x=points[:, 0], y=points[:, 1])),),
+        lambda df: calculate_distance_matrix(df, dist_metric='euclidean')),
+    'calculate_M1': (True,
+        _graphs,
+        lambda G_org, G_proj, d_org, d_proj, k: calculate_M1(G_org, G_proj, d_org, k)),
+    'calculate_M2': (True,
+        _graphs,
+        lambda G_org, G_proj, d_org, d_proj, k: calculate_M2(G_org, G_proj, d_proj, k)),
+    'calculate_M1_M2': (True,
+        lambda points, ordering, k: (points, ordering, [k], DistanceMatrix.from_array(points),
+                                     LinearDistanceMatrix(ordering)),
+        calculate_M1_M2),
+    'calculate_metric_stress': (True,
+        _dense_distances,
+        calculate_metric_stress),
+    'calculate_nonmetric_stress': (True,
+        _dense_distances,
+        calculate_nonmetric_stress),
+    'quality_exact': (True,
+        lambda points, ordering, k: (points, ordering, k),
+        lambda points, ordering, k: Projection()._calculate_quality_metrics(points, ordering, k, False)),
+    'quality_approx': (False,
+        lambda points, ordering, k: (points, ordering, k),
+        lambda points, ordering, k: Projection()._calculate_quality_metrics(points, ordering, k, False,
+                                                                            mode='approx')),
+}
+
+
+def run_benchmark(function, setup, points, ordering, k, repeat, memory):
+    times = []
+    for _ in range(repeat):
+        args = setup(points, ordering, k)
+        gc.collect()
+
+        t0 = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - t0)
+
+        del args
+
+    result = dict(times=times, best=min(times), mean=float(np.mean(times)))
+
+    if memory:
+        # separate run, tracing allocations slows down the function
+        args = setup(points, ordering, k)
+        gc.collect()
+
+        tracemalloc.start()
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        result['peak_memory'] = peak
+
+    return result
+
+
+def environment():
+    return dict(
+        created=datetime.now().strftime('%Y%m%dT%H%M%S'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        sklearn=sklearn.__version__,
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the quality metrics on synthetic point clouds.')
+    parser.add_argument('-o', '--output', metavar='<output.json>', default='bench_qualitymetrics.json',
+            help='Output file for the results (default: %(default)s)')
+    parser.add_argument('-n', '--sizes', metavar='N', type=int, nargs='+', default=DEFAULT_SIZES,
+            help='Numbers of points (default: %(default)s)')
+    parser.add_argument('-b', '--benchmarks', metavar='NAME', nargs='+', choices=list(BENCHMARKS),
+            default=list(BENCHMARKS), help='Benchmarks to run (default: all)')
+    parser.add_argument('-k', type=int, default=5, help='Neighborhood size (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed repetitions (default: %(default)s)')
+    parser.add_argument('--dense-limit', type=int, default=5000,
+            help='Largest N for benchmarks that need an N×N matrix (default: %(default)s)')
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure peak memory')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data (default: %(default)s)')
+
+    parsed = parser.parse_args(sys.argv[1:])
+
+    results = []
+    for n in parsed.sizes:
+        points, ordering = synthetic_data(n, parsed.seed)
+        k = min(parsed.k, n // 2)
+
+        for name in parsed.benchmarks:
+            dense, setup, function = BENCHMARKS[name]
+
+            if dense and n > parsed.dense_limit:
+                logging.info('Skipping %s for N=%d (above the dense limit).', name, n)
+                results.append(dict(benchmark=name, n=n, skipped='dense limit'))
+                continue
+
+            logging.info('Running %s for N=%d.', name, n)
+            result = run_benchmark(function, setup, points, ordering, k, parsed.repeat, not parsed.no_memory)
+            logging.info('  best %.4fs%s', result['best'],
+                    F', peak {result["peak_memory"] / 1048576:.1f}MiB' if 'peak_memory' in result else '')
+
+            results.append(dict(benchmark=name, n=n, k=k, **result))
+
+    with open(parsed.output, 'w') as f:
+        json.dump(dict(environment=environment(), arguments=vars(parsed), results=results), f, indent=2)
+
+    logging.info('Wrote results to %s', parsed.output)
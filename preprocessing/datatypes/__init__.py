@@ -1,5 +1,4 @@
 import json
-from operator import attrgetter
 
 from .datum import Datum
 from .timeseries import TimeseriesSpecification as _TimeseriesSpecification
@@ -37,4 +36,11 @@ class Dataset(Serializable):
 
 
     def to_json(self, out, **kwargs):
-        return json.dump(self, out, default=attrgetter('__dict__'), **kwargs)
+        return json.dump(self, out, default=_to_json, **kwargs)
+
+
+def _to_json(obj):
+    # e.g., a SpilledProjection creates its <projection> object only while it is written
+    if hasattr(obj, 'to_json_dict'):
+        return obj.to_json_dict()
+    return obj.__dict__
@@ -0,0 +1,161 @@
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+from sklearn.metrics import pairwise_distances
+
+from projections.qualitymetrics import LinearDistanceMatrix, calculate_doubled_ranks, \
+    get_knn_indices_for_sweep, get_knn_adjacency, get_M_norm_factor, _neighborhood_difference, sample_pairs, \
+    calculate_nonmetric_stress_from_vectors
+
+
+# below this many nodes, the quality metrics are always computed exactly
+APPROXIMATE_QUALITY_MIN_NODES = 5000
+
+# z-score of the two-sided 95% confidence intervals
+_Z = 1.959963984540054
+
+
+def calculate_approximate_quality(points, ordering, k_vec, n_nodes=1000, n_pairs=100000, n_batches=10,
+        block_size=64, seed=0):
+    '''
+    Estimate the quality metrics of a 1D projection from random samples,
+    instead of computing them from all N² pairs.
+
+    * M1 sums distance ranks in the original space, which need a full row of
+      distances per node. It is estimated from a sample of `n_nodes`
+      reference nodes.
+    * M2 only needs ranks in the projection, which `LinearDistanceMatrix`
+      provides in closed form, so it is computed exactly.
+    * The metric stress is estimated from a sample of `n_pairs` node pairs.
+      Its denominator and the normalization by the largest distance are exact.
+    * The nonmetric stress is the isotonic-regression stress of the sampled
+      pairs. Its confidence interval comes from `n_batches` batch means and
+      does not account for the slight downward bias of fitting the isotonic
+      regression to a sample.
+
+    @param points       numpy.ndarray of shape (N, 2)
+    @param ordering     Permutation of `0..N-1`, the position of each point
+    @param k_vec        Iterable of neighborhood sizes, M1 and M2 are
+                        averaged over them.
+    @param seed         Seed for the random samples, so that results are
+                        reproducible.
+
+    @returns            dict with the estimates of `M1`, `M2`, `metric_stress`
+                        and `nonmetric_stress`, and for each a 95% confidence
+                        interval `<metric>_ci` as a list `[low, high]`.
+    '''
+    rng = np.random.RandomState(seed)
+    points = np.asarray(points, dtype=float)
+    d_proj = LinearDistanceMatrix(ordering)
+    N = len(points)
+
+    result = dict()
+    result.update(_estimate_M1_M2(points, d_proj, k_vec, rng.choice(N, size=min(n_nodes, N), replace=False),
+                                  block_size))
+
+    i, j = sample_pairs(N, n_pairs, rng)
+
+    diss_org = np.sqrt(np.sum((points[i] - points[j]) ** 2, axis=1))
+    diss_proj = np.abs(d_proj.positions[i] - d_proj.positions[j]).astype(float)
+
+    result.update(_estimate_metric_stress(points, diss_org, diss_proj, N))
+    result.update(_estimate_nonmetric_stress(diss_org, diss_proj, n_batches))
+
+    return result
+
+
+def _estimate_M1_M2(points, d_proj, k_vec, nodes, block_size):
+    N = len(points)
+    nodes = np.sort(nodes)
+
+    M2 = []
+    pair_rows, pair_cols, pair_k, pair_norm = [], [], [], []
+    knn_org, knn_proj = get_knn_indices_for_sweep(points, None, None, d_proj, max(k_vec))
+    for k in k_vec:
+        adjacency_org = get_knn_adjacency(knn_org[:, :k - 1])
+        adjacency_proj = get_knn_adjacency(knn_proj[:, :k - 1])
+        norm_factor = get_M_norm_factor(N, k)
+
+        # M2: exact, ranks in the projection are cheap
+        rows, cols = _neighborhood_difference(adjacency_org, adjacency_proj)
+        M2.append(1 - norm_factor * np.sum(d_proj.get_ranks_by_matrix_index(rows, cols) - k))
+
+        # M1: only the neighborhoods of the sampled nodes (rows index into `nodes`)
+        rows, cols = _neighborhood_difference(adjacency_proj[nodes], adjacency_org[nodes])
+        pair_rows.append(rows)
+        pair_cols.append(cols)
+        pair_k.append(np.full(rows.size, k))
+        pair_norm.append(np.full(rows.size, norm_factor))
+
+    rows = np.concatenate(pair_rows)
+    cols = np.concatenate(pair_cols)
+    k = np.concatenate(pair_k)
+    norm_factor = np.concatenate(pair_norm)
+
+    # ranks in the original space: one block of distance rows at a time
+    ranks = np.empty(rows.size, dtype=float)
+    for b0 in range(0, len(nodes), block_size):
+        b1 = min(b0 + block_size, len(nodes))
+        mask = (rows >= b0) & (rows < b1)
+
+        doubled = calculate_doubled_ranks(pairwise_distances(points[nodes[b0:b1]], points))
+        ranks[mask] = doubled[rows[mask] - b0, cols[mask]] / 2
+
+    # per-node share of the rank sum, averaged over all k
+    contributions = np.bincount(rows, weights=norm_factor * (ranks - k), minlength=len(nodes)) / len(k_vec)
+
+    M1 = 1 - N * np.mean(contributions)
+    if len(nodes) > 1:
+        # with finite population correction, so that sampling all nodes gives an exact result
+        se = N * np.std(contributions, ddof=1) / np.sqrt(len(nodes)) * np.sqrt(1 - len(nodes) / N)
+    else:
+        se = np.inf
+
+    M2 = np.mean(M2)
+
+    return dict(M1=float(M1), M1_ci=[float(M1 - _Z * se), float(M1 + _Z * se)],
+                M2=float(M2), M2_ci=[float(M2), float(M2)])
+
+
+def _diameter(points):
+    # the largest distance is between two vertices of the convex hull
+    try:
+        vertices = points[ConvexHull(points).vertices]
+    except QhullError:
+        # degenerate (e.g., collinear) point sets: extreme points along both axes
+        vertices = points[np.unique([np.argmin(points[:, 0]), np.argmax(points[:, 0]),
+                                     np.argmin(points[:, 1]), np.argmax(points[:, 1])])]
+
+    return np.max(pairwise_distances(vertices))
+
+
+def _estimate_metric_stress(points, diss_org, diss_proj, N):
+    # same normalization as the exact computation: by the largest distance in each space
+    d_org_max = _diameter(points)
+    d_proj_max = N - 1
+
+    # sum of all squared distances in the projection, in closed form
+    d = np.arange(1, N, dtype=float)
+    denominator = np.sum((N - d) * d ** 2) / d_proj_max ** 2
+
+    n_total = N * (N - 1) / 2
+    squared = (diss_proj / d_proj_max - diss_org / d_org_max) ** 2
+
+    numerator = n_total * np.mean(squared)
+    se = n_total * np.std(squared, ddof=1) / np.sqrt(squared.size)
+
+    low = max(numerator - _Z * se, 0)
+    high = numerator + _Z * se
+
+    return dict(metric_stress=float(np.sqrt(numerator / denominator)),
+                metric_stress_ci=[float(np.sqrt(low / denominator)), float(np.sqrt(high / denominator))])
+
+
+def _estimate_nonmetric_stress(diss_org, diss_proj, n_batches):
+    stress = calculate_nonmetric_stress_from_vectors(diss_org, diss_proj)
+
+    batches = [ calculate_nonmetric_stress_from_vectors(o, p)
+            for o, p in zip(np.array_split(diss_org, n_batches), np.array_split(diss_proj, n_batches)) ]
+    se = np.std(batches, ddof=1) / np.sqrt(n_batches) if n_batches > 1 else np.inf
+
+    return dict(nonmetric_stress=float(stress),
+                nonmetric_stress_ci=[float(stress - _Z * se), float(stress + _Z * se)])
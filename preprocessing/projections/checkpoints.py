@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from datatypes.projection import Projection as ProjectionData
+from projections.ordercache import CACHE_VERSION, _digest, write_json_atomic
+from projections.sinks import SpilledProjection
+
+
+class ProjectionCheckpoints:
+    '''
+    Finished <projection> objects of a run, so that a run that did not
+    finish (e.g., a worker ran out of memory) can be resumed without
+    recomputing them.
+
+    Each projection is a JSON file in `directory`, addressed by a hash of the
+    forest (ids, coordinates, hierarchy and the time series the projection
+    uses) and of the configuration of the projection: its class, key, name,
+    description and kwargs, and the settings of the quality metrics. As for
+    the `OrderCache`, changes of the code are only noticed through
+    `CACHE_VERSION`.
+
+    @param directory    Directory of the checkpoints, created if it does not exist.
+
+    @param resume       If False, checkpoints are written, but existing ones
+                        are not used.
+    '''
+    def __init__(self, directory, resume=True):
+        self.directory = directory
+        self.resume = resume
+        os.makedirs(directory, exist_ok=True)
+
+        # digest of the last forest, which is the same for all projections of a run
+        self._forest = (None, None)
+
+
+    def key(self, forest, projection_class, key, name, description, kwargs, timeseries=None, **settings):
+        '''
+        Hex digest of the inputs of a <projection>.
+
+        @param forest       `SharedForest` of the run.
+
+        @param timeseries   Name of the time series of `forest` that the
+                            projection uses, or None. A `tsfunc` in `kwargs`
+                            is only represented by them.
+
+        @param settings     The quality settings (`k_max`, `k_vec`, ...).
+        '''
+        h = hashlib.sha256()
+        h.update(F'{CACHE_VERSION}\0{projection_class.__module__}.{projection_class.__qualname__}\0'.encode())
+        h.update(self._forest_digest(forest))
+        if timeseries is not None:
+            h.update(_array_digest(forest.arrays[timeseries]))
+
+        h.update(_digest((key, name, description)))
+        h.update(_digest({ k: v for k, v in kwargs.items() if k != 'tsfunc' }))
+        h.update(_digest(settings))
+
+        return h.hexdigest()
+
+
+    def _forest_digest(self, forest):
+        if self._forest[0] is not forest:
+            h = hashlib.sha256()
+            h.update(_digest(forest.ids))
+            for name in ('lat', 'lng', 'x', 'y', 'parent', 'subtree_datum', 'subtree_offset', 'children'):
+                h.update(_array_digest(forest.arrays[name]))
+            self._forest = (forest, h.digest())
+        return self._forest[1]
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, F'{key}.json')
+
+
+    def get(self, key):
+        '''
+        The <projection> object of a checkpoint, or None.
+        '''
+        if not self.resume:
+            return None
+
+        try:
+            with open(self._path(key)) as f:
+                return ProjectionData.from_json(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+
+    def put(self, key, projection):
+        if isinstance(projection, SpilledProjection):
+            projection = projection.load()
+        write_json_atomic(self._path(key), projection)
+
+
+def _array_digest(array):
+    return _digest(np.asarray(array))
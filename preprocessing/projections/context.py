@@ -0,0 +1,108 @@
+import numpy as np
+from scipy.spatial.distance import pdist
+
+from projections.qualitymetrics import DistanceMatrix, HaversineDistanceMatrix, get_kneighbor_candidates
+
+
+class SubtreeContext:
+    '''
+    Everything that the projections of one subtree (a list of sibling
+    <datum>) can share: coordinates, distances, time series, and the inputs
+    of the quality metrics in the original space. Each is computed on first
+    use and then kept for the other projections.
+
+    @param data             <datum>[] of the subtree.
+
+    @param coordinates      `ProjectedCoordinates` of the forest.
+
+    @param distance_storage Optional `DistanceStorage` for the distance matrix
+                            of the quality metrics.
+    '''
+    def __init__(self, data, coordinates, distance_storage=None):
+        self.data = data
+        self.coordinates = coordinates
+        self.distance_storage = distance_storage
+        self.index = { d.id: i for i, d in enumerate(data) }
+        self._cache = dict()
+
+
+    def cached(self, key, function):
+        '''
+        Returns `function()`, which is only called the first time for `key`.
+        '''
+        if key not in self._cache:
+            self._cache[key] = function()
+        return self._cache[key]
+
+
+    def indices(self, data):
+        '''
+        The index in the context of each <datum> in `data`.
+        '''
+        return np.fromiter((self.index[d.id] for d in data), dtype=np.int64, count=len(data))
+
+
+    @property
+    def ids(self):
+        return self.cached('ids', lambda: [ d.id for d in self.data ])
+
+
+    @property
+    def xy(self):
+        return self.cached('xy', lambda: self.coordinates.xy(self.data))
+
+
+    @property
+    def lat_lng(self):
+        return self.cached('lat_lng', lambda: np.array([ [d.lat, d.lng] for d in self.data ], dtype=float))
+
+
+    def condensed_distances(self):
+        '''
+        Euclidean distances between the EPSG3857 coordinates, as returned by
+        `scipy.spatial.distance.pdist`.
+        '''
+        return self.cached('condensed_distances', lambda: pdist(self.xy))
+
+
+    def timeseries(self, tsfunc, tslen):
+        '''
+        numpy.ndarray of shape (len(data), tslen) with `tsfunc(datum)` in each row.
+        '''
+        def create():
+            samples = np.ndarray(shape=(len(self.data), tslen), dtype=float)
+            for i, d in enumerate(self.data):
+                samples[i] = tsfunc(d)
+            return samples
+
+        return self.cached(('timeseries', tsfunc, tslen), create)
+
+
+    def distance_matrix(self, distance_metric='euclidean'):
+        '''
+        `DistanceMatrix` (or `HaversineDistanceMatrix`) of the subtree, for the
+        quality metrics. Its ranks are computed once for all projections.
+        '''
+        def create():
+            if distance_metric == 'haversine':
+                return HaversineDistanceMatrix(self.lat_lng)
+            return DistanceMatrix.from_array(self.xy, storage=self.distance_storage)
+
+        return self.cached(('distance_matrix', distance_metric), create)
+
+
+    def max_distance(self, distance_metric='euclidean'):
+        return self.cached(('max_distance', distance_metric),
+                lambda: self.distance_matrix(distance_metric).distance_matrix.max())
+
+
+    def kneighbor_candidates(self, distance_metric, k):
+        '''
+        Candidates for the `k` nearest neighbors, see `get_kneighbor_candidates`.
+        '''
+        def create():
+            if distance_metric == 'haversine':
+                return self.distance_matrix(distance_metric).get_kneighbor_candidates(k)
+            return get_kneighbor_candidates(self.xy, k)
+
+        return self.cached(('kneighbor_candidates', distance_metric, k), create)
@@ -0,0 +1,145 @@
+import tempfile
+
+import numpy as np
+
+
+# approximate number of matrix entries computed at once when filling a storage
+BLOCK_ELEMENTS = 2**22
+
+
+class DistanceStorage:
+    '''
+    Configuration of how a distance matrix is stored.
+
+    @param layout           'dense' for a full N×N matrix, 'condensed' for
+                            only the upper triangle, as returned by
+                            `scipy.spatial.distance.pdist`.
+
+    @param dtype            numpy.float64 or numpy.float32
+
+    @param memmap_threshold For N at or above this, the storage is backed by
+                            a `numpy.memmap` of a temporary file instead of
+                            memory. `None` disables memory mapping.
+
+    @param memmap_dir       Directory for the temporary files, defaults to
+                            the system's temporary directory.
+    '''
+    def __init__(self, layout='dense', dtype=np.float64, memmap_threshold=None, memmap_dir=None):
+        if layout not in ('dense', 'condensed'):
+            raise ValueError(F'Unknown distance storage layout {layout}')
+
+        self.layout = layout
+        self.dtype = np.dtype(dtype)
+        self.memmap_threshold = memmap_threshold
+        self.memmap_dir = memmap_dir
+
+
+    def _allocate(self, n, shape):
+        if self.memmap_threshold is not None and n >= self.memmap_threshold and np.prod(shape) > 0:
+            # the file is removed as soon as it is closed, the mapping stays valid
+            with tempfile.TemporaryFile(dir=self.memmap_dir) as f:
+                return np.memmap(f, dtype=self.dtype, mode='w+', shape=shape)
+
+        return np.empty(shape, dtype=self.dtype)
+
+
+    def create(self, n, row_function):
+        '''
+        Create the storage for `n` points.
+
+        @param row_function A function `(i0, i1) -> numpy.ndarray` returning
+                            the distances of points `i0..i1-1` to all `n`
+                            points, of shape (i1 - i0, n).
+
+        @returns            A numpy.ndarray (or numpy.memmap) of shape (n, n)
+                            for the dense layout, or `CondensedDistances`.
+        '''
+        block_size = max(1, BLOCK_ELEMENTS // max(n, 1))
+
+        if self.layout == 'dense':
+            D = self._allocate(n, (n, n))
+            for i0 in range(0, n, block_size):
+                i1 = min(i0 + block_size, n)
+                D[i0:i1] = row_function(i0, i1)
+
+            return D
+
+        condensed = self._allocate(n, (n * (n - 1) // 2,))
+        for i0 in range(0, n, block_size):
+            i1 = min(i0 + block_size, n)
+            block = row_function(i0, i1)
+
+            for i in range(i0, i1):
+                offset = _condensed_offset(i, n)
+                condensed[offset:offset + n - i - 1] = block[i - i0, i + 1:]
+
+        return CondensedDistances(condensed, n)
+
+
+def _condensed_offset(i, n):
+    # position of entry (i, i+1) in the condensed vector
+    return i * n - i * (i + 1) // 2
+
+
+class CondensedDistances:
+    '''
+    Read-only, array-like view of a symmetric distance matrix with zero
+    diagonal, stored as its condensed upper triangle. Indexing with two
+    slices/integers returns a dense block, indexing with two index arrays
+    returns the element-wise pairs, as for a numpy.ndarray.
+    '''
+    def __init__(self, condensed, n, scale=1.0):
+        self.condensed = condensed
+        self.n = n
+        self.scale = scale
+        self.shape = (n, n)
+
+
+    def _lookup(self, rows, cols):
+        rows, cols = np.broadcast_arrays(rows, cols)
+        if self.condensed.size == 0:
+            return np.zeros(rows.shape)
+
+        a = np.minimum(rows, cols)
+        b = np.maximum(rows, cols)
+
+        index = a * self.n - a * (a + 1) // 2 + (b - a - 1)
+        diagonal = a == b
+        values = self.condensed[np.where(diagonal, 0, index)].astype(np.float64)
+        values[diagonal] = 0
+
+        return values * self.scale
+
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, (slice, int, np.integer)) or isinstance(cols, (slice, int, np.integer)):
+            indices = np.arange(self.n)
+            block = self._lookup(np.atleast_1d(indices[rows])[:, np.newaxis],
+                                 np.atleast_1d(indices[cols])[np.newaxis, :])
+
+            if isinstance(rows, (int, np.integer)):
+                block = block[0]
+            if isinstance(cols, (int, np.integer)):
+                block = block[..., 0]
+
+            return block
+
+        return self._lookup(np.asarray(rows), np.asarray(cols))
+
+
+    def __truediv__(self, divisor):
+        return CondensedDistances(self.condensed, self.n, self.scale / divisor)
+
+
+    def max(self):
+        if self.condensed.size == 0:
+            return 0.0
+        return float(np.max(self.condensed)) * self.scale
+
+
+    def upper_triangle(self):
+        '''
+        The entries above the diagonal, in the order of `numpy.triu_indices`.
+        '''
+        return self.condensed.astype(np.float64) * self.scale
@@ -1,5 +1,4 @@
-from projections.projection import GeospatialProjection
-from util.quadtree import Point
+from projections.projection import ArrayProjection
 
 from scipy.cluster.hierarchy import linkage, leaves_list
 import numpy as np
@@ -8,40 +7,41 @@ from tslearn.metrics import dtw
 import logging
 
 
-class DTWProjection(GeospatialProjection):
+class DTWProjection(ArrayProjection):
+    uses_timeseries = True
+    # one merge of two entities keeps their order
+    trivial_size = 2
+
     def timeseries_comparison(self, ts1, ts2):
         return 0.0
 
 
-    def add_data(self, data, tslen=1, tsfunc=lambda x: x.data, method='single', **kwargs):
+    def add_data(self, xy, ids=None, timeseries=None, context=None, method='single', **kwargs):
         self.kwargs = kwargs
 
-        if len(data) == 1:
-            self.data = [ Point(self.x_fn(data[0]), self.y_fn(data[0]), data[0]) ]
+        if len(xy) == 1:
+            self.permutation = np.zeros(1, dtype=np.int64)
             return
 
-        samples = np.ndarray(shape=(len(data), tslen), dtype=float)
-        for i in range(len(data)):
-            samples[i] = tsfunc(data[i])
-
-        distances = np.zeros(shape=((len(data) * (len(data) - 1))//2,), dtype=float)
+        distances = np.zeros(shape=((len(xy) * (len(xy) - 1))//2,), dtype=float)
         idx = 0
-        for i, a in enumerate(samples):
-            for b in samples[i+1:]:
+        for i, a in enumerate(timeseries):
+            for b in timeseries[i+1:]:
                 distances[idx] = self.timeseries_comparison(a, b, **kwargs)
                 idx += 1
 
         Z = linkage(distances, method)
-        order = leaves_list(Z)
+        self.permutation = leaves_list(Z)
+
 
-        self.data = []
-        for i in order:
-            d = data[i]
-            self.data.append(Point(self.x_fn(d), self.y_fn(d), d))
+    @classmethod
+    def estimate_cost(cls, n, tslen=1, **kwargs):
+        # one comparison of two time series per pair
+        return n * (n - 1) / 2 * tslen
 
 
-    def _order(self):
-        return self.data
+    def order(self):
+        return self.permutation
 
 
     def metadata(self):
@@ -53,6 +53,13 @@ class DynamicTimeWarpingProjection(DTWProjection):
         return 1.0 / (1.0 + dtw(X0, X1, global_constraint=global_constraint))
 
 
+    @classmethod
+    def estimate_cost(cls, n, tslen=1, global_constraint=None, **kwargs):
+        # dynamic programming over (a band of) tslen x tslen cells per pair
+        band = tslen if global_constraint is None else max(np.sqrt(tslen), 1)
+        return n * (n - 1) / 2 * tslen * band
+
+
     def metadata(self):
         if self.kwargs['global_constraint'] is None:
             return dict()
@@ -1,5 +1,4 @@
-from projections.projection import GeospatialProjection
-from util.quadtree import Point
+from projections.projection import ArrayProjection
 
 from scipy.cluster.hierarchy import linkage, leaves_list
 import numpy as np
@@ -8,7 +7,9 @@ from tslearn.metrics import dtw
 import logging
 
 
-class FirstOccurrenceProjection(GeospatialProjection):
+class FirstOccurrenceProjection(ArrayProjection):
+    uses_timeseries = True
+
     @staticmethod
     def first_occurrence_index(ts, threshold=0):
         i = 0
@@ -16,26 +17,27 @@ class FirstOccurrenceProjection(GeospatialProjection):
             i += 1
         return i
 
-    def add_data(self, data, tslen=1, tsfunc=lambda x: x.data, **kwargs):
+    def add_data(self, xy, ids=None, timeseries=None, context=None, **kwargs):
         self.kwargs = kwargs
 
-        if len(data) == 1:
-            self.data = [ Point(self.x_fn(data[0]), self.y_fn(data[0]), data[0]) ]
+        if len(xy) == 1:
+            self.permutation = np.zeros(1, dtype=np.int64)
             return
 
-        maxval = max([max(tsfunc(d)) for d in data])
+        maxval = max([max(ts) for ts in timeseries])
         threshold = maxval * 0.01
 
-        order = [ (d, FirstOccurrenceProjection.first_occurrence_index(tsfunc(d), threshold)) for d in data ]
-        order = sorted(order, key=lambda x: x[1])
+        first = [ FirstOccurrenceProjection.first_occurrence_index(ts, threshold) for ts in timeseries ]
+        self.permutation = np.argsort(first, kind='stable')
+
 
-        self.data = []
-        for d,_ in order:
-            self.data.append(Point(self.x_fn(d), self.y_fn(d), d))
+    @classmethod
+    def estimate_cost(cls, n, tslen=1, **kwargs):
+        return n * tslen
 
 
-    def _order(self):
-        return self.data
+    def order(self):
+        return self.permutation
 
 
     def metadata(self):
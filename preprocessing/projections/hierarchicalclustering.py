@@ -1,75 +1,69 @@
-from util.quadtree import Point
-from projections.projection import GeospatialProjection
+from projections.projection import ArrayProjection
 
 from scipy.cluster.hierarchy import linkage, leaves_list
 from scipy.spatial.distance import euclidean
 import numpy as np
 
 
-class HierarchicalClusteringProjection(GeospatialProjection):
-    def add_data(self, data, method='single', metric='euclidean'):
-        samples = np.ndarray(shape=(len(data), 2), dtype=float)
-        for i,d in enumerate(data):
-            samples[i,0] = self.x_fn(d)
-            samples[i,1] = self.y_fn(d)
+class HierarchicalClusteringProjection(ArrayProjection):
+    # one merge of two entities keeps their order
+    trivial_size = 2
 
-        if len(data) == 1:
+    def add_data(self, xy, ids=None, timeseries=None, context=None, method='single', metric='euclidean'):
+        if len(xy) == 1:
             # distance matrix empty
-            self.data = [ Point(samples[0,0], samples[0,1], data[0]) ]
+            self.permutation = np.zeros(1, dtype=np.int64)
             return
 
-        Z = linkage(samples, method, metric)
-        order = leaves_list(Z)
+        if context is not None and metric == 'euclidean':
+            # same as computing them from the samples, but shared by all linkage methods
+            Z = linkage(context.condensed_distances(), method)
+        else:
+            Z = linkage(xy, method, metric)
+        self.permutation = leaves_list(Z)
 
-        self.data = [ Point(samples[i,0], samples[i,1], data[i]) for i in order ]
 
-
-    def _order(self):
-        return self.data
+    def order(self):
+        return self.permutation
 
 
     def metadata(self):
         return dict()
 
 
-class HierarchicalClusteringFlightdataProjection(GeospatialProjection):
-    def add_data(self, data, flightdata=None, method='single'):
-        samples = np.ndarray(shape=(len(data), 2), dtype=float)
-        for i,d in enumerate(data):
-            samples[i,0] = self.x_fn(d)
-            samples[i,1] = self.y_fn(d)
+class HierarchicalClusteringFlightdataProjection(ArrayProjection):
+    trivial_size = 2
 
-        if len(data) == 1:
+    def add_data(self, xy, ids=None, timeseries=None, context=None, flightdata=None, method='single'):
+        if len(xy) == 1:
             # distance matrix empty
-            self.data = [ Point(samples[0,0], samples[0,1], data[0]) ]
+            self.permutation = np.zeros(1, dtype=np.int64)
             return
 
-        distances = np.zeros(shape=((len(data) * (len(data) - 1))//2,), dtype=float)
+        distances = np.zeros(shape=((len(xy) * (len(xy) - 1))//2,), dtype=float)
         idx = 0
-        for i, a in enumerate(data):
-            for j, b in enumerate(data[i+1:]):
-                idx_a = flightdata['indices'].get(a.id, None)
-                idx_b = flightdata['indices'].get(b.id, None)
+        for i, a in enumerate(ids):
+            for j, b in enumerate(ids[i+1:]):
+                idx_a = flightdata['indices'].get(a, None)
+                idx_b = flightdata['indices'].get(b, None)
 
                 if idx_a is not None and idx_b is not None:
                     flow = flightdata['matrix'][idx_a * flightdata['size'] + idx_b]
                     if flow is not None and flow != 0:
                         distances[idx] = 1 / flow
                     else:
-                        distances[idx] = euclidean(samples[i], samples[j])
+                        distances[idx] = euclidean(xy[i], xy[j])
                 else:
-                    distances[idx] = euclidean(samples[i], samples[j])
+                    distances[idx] = euclidean(xy[i], xy[j])
 
                 idx += 1
 
         Z = linkage(distances, method)
-        order = leaves_list(Z)
-
-        self.data = [ Point(samples[i,0], samples[i,1], data[i]) for i in order ]
+        self.permutation = leaves_list(Z)
 
 
-    def _order(self):
-        return self.data
+    def order(self):
+        return self.permutation
 
 
     def metadata(self):
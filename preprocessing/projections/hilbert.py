@@ -1,56 +1,16 @@
-from math import isnan, isinf
-from operator import attrgetter
+import numpy as np
 
-from util.quadtree import Quadtree, Point
-from projections.projection import GeospatialProjection
+from projections.projection import SpaceFillingCurveProjection
+from util.spacefillingcurves import curve_ranks
 
 
-class HilbertProjection(GeospatialProjection):
-    def add_data(self, data):
-        self.data = [ Point(self.x_fn(d), self.y_fn(d), d) for d in data ]
-
-        unwell = list(filter(lambda p: isnan(p.x) or isnan(p.y) or isinf(p.x) or isinf(p.y), self.data))
-        if len(unwell) > 0:
-            import sys
-            sys.stderr.write('Points with invalid coordinates:\n')
-            for w in unwell:
-                sys.stderr.write(F'  {w.data.name}  {w.data.lat} {w.data.lng}\n')
-
-            sys.exit(1)
-
-        getx = attrgetter('x')
-        gety = attrgetter('y')
-
-        min_x = min(map(getx, self.data))
-        max_x = max(map(getx, self.data))
-        min_y = min(map(gety, self.data))
-        max_y = max(map(gety, self.data))
-
-        # squarify domain
-        dx = max_x - min_x
-        dy = max_y - min_y
-        if dx > dy:
-            delta = dx - dy
-            min_y -= delta/2
-            max_y += delta/2
-        else:
-            delta = dy - dx
-            min_x -= delta/2
-            max_x += delta/2
-
-        self.quadtree = Quadtree(min_x, min_y, max_x, max_y)
-
-        for datum in self.data:
-            self.quadtree.add_point(datum)
-
-
-    def _order(self):
-        order = []
-        _visit_quadtree_node(order, self.quadtree.root, 0, 'A')
-        return order
+class HilbertProjection(SpaceFillingCurveProjection):
+    def curve_ranks(self, xy, bounds):
+        return curve_ranks(xy, bounds, _transitions)
 
 
 def _visit_quadtree_node(curve, node, rotation, pattern):
+    # the same curve as a traversal of a `Quadtree`, e.g., to plot it
     if node.children is not None:
         order = _lindenmayer[pattern]
         for pat, rot, idx_unrot in order:
@@ -61,9 +21,10 @@ def _visit_quadtree_node(curve, node, rotation, pattern):
             _visit_quadtree_node(curve, node.children[idx], (rotation + rot + 4)%4, pat)
 
     else:
-        curve.append(node.datum)
+        curve.extend(node.points)
 
 
+# for each pattern: the (pattern, rotation, unrotated quadrant) of the children, in curve order
 _lindenmayer = {
         'A': [
             ('B', -1, 0),
@@ -84,3 +45,19 @@ _rotations = [
         [3, 2, 1, 0],
         [2, 0, 3, 1]
         ]
+
+
+def _create_transitions():
+    # state 4 * pattern + rotation, for curve_order
+    patterns = sorted(_lindenmayer)
+    transitions = np.zeros((4 * len(patterns), 4, 2), dtype=np.int64)
+    for p, pattern in enumerate(patterns):
+        for rotation in range(4):
+            for position, (child_pattern, rot, idx_unrot) in enumerate(_lindenmayer[pattern]):
+                idx = _rotations[rotation][idx_unrot]
+                transitions[4 * p + rotation, idx] = \
+                    (position, 4 * patterns.index(child_pattern) + (rotation + rot + 4) % 4)
+    return transitions
+
+
+_transitions = _create_transitions()
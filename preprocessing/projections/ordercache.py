@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from datatypes.projection import SubtreeLevelOrder
+
+
+# part of every key: increment it when a change of the code changes orders or quality metrics
+CACHE_VERSION = 1
+
+
+class OrderCache:
+    '''
+    On-disk cache of `SubtreeLevelOrder` objects, addressed by a hash of
+    everything they are computed from: the ids and coordinates of the
+    subtree, the time series if the projection uses them, the projection
+    class and its kwargs, and the settings of the quality metrics.
+
+    Each entry is a JSON file in `directory`. Files are written atomically,
+    so that several processes can share a cache. Changes of the code are
+    only noticed through `CACHE_VERSION`.
+
+    @param directory    Directory of the cache, created if it does not exist.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # digests of the values of kwargs, which are the same objects for all subtrees of a projection
+        self._value_digests = dict()
+
+
+    def key(self, projection_class, context, kwargs, timeseries=None, **settings):
+        '''
+        Hex digest of the inputs of a `SubtreeLevelOrder`.
+
+        @param projection_class  `ArrayProjection` or `Projection` class.
+
+        @param context      `SubtreeContext` of the subtree.
+
+        @param kwargs       kwargs of the projection. A `tsfunc` is only
+                            represented by the `timeseries` it creates.
+
+        @param timeseries   numpy.ndarray with the time series of the subtree,
+                            or None if the projection does not use them.
+
+        @param settings     The quality settings (`k_max`, `k_vec`, ...).
+        '''
+        h = hashlib.sha256()
+        h.update(F'{CACHE_VERSION}\0{projection_class.__module__}.{projection_class.__qualname__}\0'.encode())
+
+        h.update(json.dumps(context.ids).encode())
+        h.update(np.ascontiguousarray(context.lat_lng, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(context.xy, dtype=np.float64).tobytes())
+        if timeseries is not None:
+            timeseries = np.ascontiguousarray(timeseries, dtype=np.float64)
+            h.update(repr(timeseries.shape).encode())
+            h.update(timeseries.tobytes())
+
+        for k in sorted(kwargs):
+            if k != 'tsfunc':
+                h.update(_digest(k))
+                h.update(self._value_digest(kwargs[k]))
+        h.update(_digest(settings))
+
+        return h.hexdigest()
+
+
+    def _value_digest(self, value):
+        if not isinstance(value, (dict, list, tuple, np.ndarray)):
+            return _digest(value)
+
+        # large values (e.g., flight data) are digested once, the entry keeps them alive so that ids stay unique
+        if id(value) not in self._value_digests:
+            self._value_digests[id(value)] = (value, _digest(value))
+        return self._value_digests[id(value)][1]
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], F'{key}.json')
+
+
+    def get(self, key):
+        '''
+        The cached `SubtreeLevelOrder`, or None.
+        '''
+        try:
+            with open(self._path(key)) as f:
+                return SubtreeLevelOrder.from_json(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+
+    def put(self, key, order):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_atomic(path, order.__dict__)
+
+
+def write_json_atomic(path, obj):
+    '''
+    Write `obj` as JSON to `path`, so that readers either see the old file
+    or the complete new one, even if this process dies while writing.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, default=_to_json)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value.__dict__
+
+
+def _digest(value):
+    '''
+    sha256 digest of a (nested) value, independent of the order of dict keys.
+    '''
+    h = hashlib.sha256()
+
+    def _update(v):
+        if isinstance(v, dict):
+            h.update(b'{')
+            for k in sorted(v, key=repr):
+                _update(k)
+                _update(v[k])
+            h.update(b'}')
+        elif isinstance(v, (list, tuple)):
+            h.update(b'[')
+            for item in v:
+                _update(item)
+            h.update(b']')
+        elif isinstance(v, np.ndarray):
+            h.update(F'array{v.dtype.str}{v.shape}'.encode())
+            h.update(np.ascontiguousarray(v).tobytes())
+        elif callable(v):
+            h.update(F'{getattr(v, "__module__", "")}.{getattr(v, "__qualname__", repr(type(v)))}'.encode())
+        elif hasattr(v, '__dict__'):
+            # e.g., a DistanceStorage: by value, not by the default repr with its address
+            _update((type(v).__qualname__, vars(v)))
+            return
+        else:
+            h.update(F'{type(v).__name__}:{v!r}'.encode())
+        h.update(b',')
+
+    _update(value)
+    return h.digest()
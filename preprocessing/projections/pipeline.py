@@ -0,0 +1,281 @@
+import logging
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from projections.approximatequality import APPROXIMATE_QUALITY_MIN_NODES
+from projections.context import SubtreeContext
+from projections.projection import ArrayProjection, ProjectedCoordinates, as_array_projection, \
+    create_subtree_level_order, fast_path_size, iter_subtrees, timeseries_input
+from projections.sharedforest import SharedForest
+from projections.sinks import LevelOrderSink
+from util.timing import NULL_TRACER, Tracer
+
+
+# state of a worker process, set up once by _init_worker
+_worker = dict()
+
+# number of SubtreeContext objects that a worker keeps for later tasks
+CONTEXT_CACHE_SIZE = 2
+
+
+def _timeseries_inputs(projections):
+    '''
+    The distinct `(tsfunc, tslen)` of all projections, see `timeseries_input`.
+    '''
+    inputs = dict()
+    for projection_class, _, _, _, kwargs in projections:
+        key = timeseries_input(projection_class, kwargs)
+        if key is not None:
+            inputs.setdefault(key, len(inputs))
+
+    return list(inputs)
+
+
+def _uses_datum_attributes(projection_class, kwargs):
+    '''
+    Whether a projection may read attributes of the <datum> other than `id`,
+    `lat` and `lng`: `Projection` classes get the <datum> objects, and a
+    `tsfunc` that is not one of the time series of `timeseries_input` is
+    called with them.
+    '''
+    if not issubclass(projection_class, ArrayProjection):
+        return True
+    return 'tsfunc' in kwargs and timeseries_input(projection_class, kwargs) is None
+
+
+def _init_worker(handle, projections, settings, trace):
+    _setup_worker(SharedForest.attach(*handle), projections, settings, trace)
+
+
+def _setup_worker(forest, projections, settings, trace):
+    coordinates = ProjectedCoordinates.from_arrays(forest.ids, forest.arrays['x'], forest.arrays['y'])
+
+    _worker.update(forest=forest, coordinates=coordinates, projections=projections, settings=settings,
+            trace=trace, timeseries=_timeseries_inputs(projections), contexts=OrderedDict())
+
+
+def _get_context(s):
+    # least recently used cache: the distance matrices of large subtrees do not all fit in memory
+    contexts = _worker['contexts']
+    if s in contexts:
+        contexts.move_to_end(s)
+        return contexts[s]
+
+    forest = _worker['forest']
+    context = SubtreeContext(forest.subtree_data(s), _worker['coordinates'], _worker['settings']['distance_storage'])
+    for t, (tsfunc, tslen) in enumerate(_worker['timeseries']):
+        # the data of the workers have no time series, only the shared forest
+        context.cached(('timeseries', tsfunc, tslen), lambda: forest.timeseries(t, s))
+
+    contexts[s] = context
+    while len(contexts) > CONTEXT_CACHE_SIZE:
+        contexts.popitem(last=False)
+
+    return context
+
+
+def _create_subtree_order(task):
+    s, j = task
+    projection_class, key, name, description, kwargs = _worker['projections'][j]
+    forest = _worker['forest']
+
+    # the spans of the task go back to the main process with its result
+    tracer = Tracer(_worker['trace']).bind(projection=key, subtree=forest.subtree_id(s),
+            n=len(forest.subtree_indices(s)))
+    with tracer.span('task'):
+        with tracer.span('context'):
+            context = _get_context(s)
+        order = create_subtree_level_order(as_array_projection(projection_class, _worker['coordinates']),
+                context, **_worker['settings'], tracer=tracer, **kwargs)
+
+    return s, j, order, tracer.spans
+
+
+def _create_subtree_orders(batch):
+    s, js = batch
+    return [ _create_subtree_order((s, j)) for j in js ]
+
+
+def _batch_tasks(tasks, costs, workers):
+    '''
+    Batches `(s, [ j, ... ])` of the tasks `(s, j)` with the estimated
+    `costs`, longest first. The projections of a subtree are one batch, so
+    that they share its `SubtreeContext`, unless the batch costs more than
+    the share of one of the `workers`: then the projections of the subtree
+    are separate batches, as running them in parallel saves more time than
+    the shared context.
+    '''
+    share = sum(costs) / workers
+    by_subtree = OrderedDict()
+    for (s, j), cost in zip(tasks, costs):
+        by_subtree.setdefault(s, []).append((j, cost))
+
+    batches = []
+    for s, items in by_subtree.items():
+        total = sum(cost for _, cost in items)
+        if total > share:
+            batches.extend((cost, s, [ j ]) for j, cost in items)
+        else:
+            batches.append((total, s, [ j for j, _ in items ]))
+
+    # the sort is stable, so batches of equal cost keep the order of the subtrees
+    batches.sort(key=lambda batch: -batch[0])
+    return [ (s, js) for _, s, js in batches ]
+
+
+def _subtree_tasks(data):
+    '''
+    (depth, parent id, number of children) of all subtrees with children, in
+    the order of `iter_subtrees`.
+    '''
+    return [ (depth, parent_id, len(children)) for depth, parent_id, children in iter_subtrees(data) ]
+
+
+def estimate_quality_cost(n, quality='exact', distance_metric='euclidean'):
+    '''
+    Rough cost of the quality metrics of `n` entities, in the units of
+    `Projection.estimate_cost`.
+    '''
+    if quality == 'approx' and distance_metric == 'euclidean' and n >= APPROXIMATE_QUALITY_MIN_NODES:
+        # sampled reference nodes and pairs
+        return 1000 * n + 2e6
+    # ranks and the nonmetric stress sort all pairs
+    return n * n * max(np.log2(n), 1)
+
+
+def create_projections_by_subtree(data, projections, k_max=5, k_vec=True, distance_storage=None, quality='exact',
+        distance_metric='euclidean', coordinates=None, processes=None, tracer=NULL_TRACER, cache=None, sink=None,
+        checkpoints=None):
+    '''
+    Create the <projection> objects of several projections of a <datum>[]
+    forest, with the same results as `create_projection` for each.
+
+    The work is split into one task per projection and subtree. The cost of
+    each task is estimated from the size of the subtree and the projection
+    (see `Projection.estimate_cost`). The tasks of a subtree are dispatched
+    to a worker together, so that its projections share one
+    `SubtreeContext`, except for subtrees that cost more than the share of
+    one worker, whose tasks are dispatched separately (see `_batch_tasks`).
+    The most expensive batches are dispatched first, so that the many small
+    ones fill up the workers at the end.
+
+    The forest is published once as a `SharedForest`, which the workers
+    attach to read-only, and the tasks only carry the numbers of the subtree
+    and the projection. The workers therefore never hold the <datum>
+    objects: projections only see `id`, `lat` and `lng`, and time series
+    through `SubtreeContext.timeseries`. If a projection may read other
+    attributes (see `_uses_datum_attributes`), all attributes of the <datum>
+    except `children` are passed to the workers as well, at the cost of
+    pickling them once per worker. `children` is never available.
+
+    @param projections  List of `(projection_class, key, name, description, kwargs)`.
+
+    @param processes    Number of worker processes, `None` for one per CPU.
+                        With 1, everything runs in this process.
+
+    @param tracer       `Tracer` for the spans of each task and its stages,
+                        recorded in the workers.
+
+    @param cache        Optional `OrderCache`, shared by all workers.
+
+    @param sink         `LevelOrderSink` that receives each `SubtreeLevelOrder`
+                        as soon as its task is finished, e.g., a `SpillSink`
+                        to keep them on disk until the output is written.
+
+    @param checkpoints  Optional `ProjectionCheckpoints`. Each projection is
+                        written to it as soon as its last subtree is
+                        finished, and projections that it already has are
+                        loaded instead of computed.
+
+    The other parameters are those of `create_projection`.
+    '''
+    if coordinates is None:
+        with tracer.span('coordinates'):
+            coordinates = ProjectedCoordinates(data)
+
+    projections = [ (cls, key if key is not None else cls.__name__, name, description, kwargs)
+            for cls, key, name, description, kwargs in projections ]
+    settings = dict(k_max=k_max, k_vec=k_vec, distance_storage=distance_storage, quality=quality,
+            distance_metric=distance_metric, cache=cache)
+
+    timeseries = _timeseries_inputs(projections)
+    subtrees = _subtree_tasks(data)
+
+    with tracer.span('shared_forest'):
+        forest = SharedForest.create(data, coordinates, timeseries,
+                any(_uses_datum_attributes(cls, kwargs) for cls, _, _, _, kwargs in projections))
+
+    if sink is None:
+        sink = LevelOrderSink()
+    projs = [ None ] * len(projections)
+    fast_path = [ 0 ] * len(projections)
+    remaining = [ len(subtrees) ] * len(projections)
+
+    checkpoint_keys = []
+    if checkpoints is not None:
+        with tracer.span('checkpoints'):
+            for j, (cls, key, name, description, kwargs) in enumerate(projections):
+                tsinput = timeseries_input(cls, kwargs)
+                checkpoint_keys.append(checkpoints.key(forest, cls, key, name, description, kwargs,
+                        F'timeseries{timeseries.index(tsinput)}' if tsinput is not None else None,
+                        k_max=k_max, k_vec=k_vec, distance_storage=distance_storage, quality=quality,
+                        distance_metric=distance_metric))
+
+                projs[j] = checkpoints.get(checkpoint_keys[j])
+                if projs[j] is not None:
+                    remaining[j] = 0
+                    logging.info('  Loaded projection %s from checkpoint.', key)
+
+    tasks, costs = [], []
+    for s, (depth, subtree_id, n) in enumerate(subtrees):
+        quality_cost = estimate_quality_cost(n, quality, distance_metric)
+        for j, (cls, _, _, _, kwargs) in enumerate(projections):
+            if remaining[j] > 0:
+                tasks.append((s, j))
+                costs.append(cls.estimate_cost(n, **kwargs) + quality_cost)
+
+    def _finish(j):
+        cls, key, name, description, _ = projections[j]
+        with tracer.span('assemble', projection=key):
+            projs[j] = sink.projection(key, name, description)
+        logging.info('  Created projection %s (%d of %d subtrees on the fast path).', key, fast_path[j],
+                len(subtrees))
+
+        if checkpoints is not None:
+            with tracer.span('checkpoint', projection=key):
+                checkpoints.put(checkpoint_keys[j], projs[j])
+
+    def _collect(results):
+        for s, j, order, spans in results:
+            cls, key = projections[j][:2]
+            depth, subtree_id, n = subtrees[s]
+            sink.add(key, s, depth, subtree_id, order)
+            fast_path[j] += n <= fast_path_size(cls)
+            tracer.extend(spans)
+
+            # as soon as a projection is complete, so that a run that fails later keeps it
+            remaining[j] -= 1
+            if remaining[j] == 0:
+                _finish(j)
+
+    with forest:
+        assert forest.n_subtrees == len(subtrees)
+
+        if processes == 1 or len(tasks) == 0:
+            # nothing to balance: subtree by subtree, so that each context is created once
+            _setup_worker(forest, projections, settings, tracer.enabled)
+            try:
+                _collect(map(_create_subtree_order, tasks))
+            finally:
+                _worker.clear()
+        else:
+            batches = _batch_tasks(tasks, costs, processes or os.cpu_count())
+            initargs = (forest.handle, projections, settings, tracer.enabled)
+            with Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+                _collect(order for results in pool.imap_unordered(_create_subtree_orders, batches, chunksize=1)
+                         for order in results)
+
+    return projs
@@ -1,12 +1,140 @@
+import inspect
 import logging
+import math
+from functools import lru_cache
+from operator import attrgetter
 
 import numpy as np
-from datatypes.projection import Projection as ProjectionData
-from datatypes.projection import SubtreeLevelOrder, PerLevelOrders
-from projections.qualitymetrics import wrapper_for_d_matrix_calculation, \
-    points_ordering_to_wildfire_structure, calculate_M1_M2_score, calculate_metric_stress, calculate_nonmetric_stress
+from datatypes.projection import SubtreeLevelOrder
+from projections.qualitymetrics import DistanceMatrix, LinearDistanceMatrix, HaversineDistanceMatrix, \
+    calculate_M1_M2, calculate_metric_stress, calculate_nonmetric_stress, get_canonical_kneighbors
+from projections.approximatequality import APPROXIMATE_QUALITY_MIN_NODES, calculate_approximate_quality
+from projections.context import SubtreeContext
+from projections.sinks import LevelOrderSink
 from pyproj import CRS, Transformer
 from pyproj.enums import TransformDirection
+from util.spacefillingcurves import squarified_bounds
+from util.timing import NULL_TRACER
+
+
+def calculate_quality_metrics(points, ordering, k_max, k_vec, distance_storage=None, mode='exact',
+        distance_metric='euclidean', context=None, context_index=None):
+    '''
+    Calculate and return quality metrics for the projection.
+
+    @param points       A numpy.ndarray of shape (l, 2), where `points[i,0]`
+                        is the x coordinate of point `i` (in EPSG3857), and
+                        `points[i,1]` is the y coordinate. `l` is the
+                        number of entities in the projection.
+
+    @param ordering     An array of indices of shape (l,). The order of the
+                        indices is the projection, and the indices
+                        reference the first index in `points`.
+
+    @param k_max        Maximum `k` for neighborhood graph
+
+    @param k_vec        Boolean: True -> use mean of multiple measurements
+                        with different `k`
+
+    @param distance_storage  Optional `DistanceStorage` for the distance
+                        matrix of `points`.
+
+    @param mode         'exact', or 'approx' to estimate the metrics from
+                        random samples (see `calculate_approximate_quality`)
+                        if there are at least `APPROXIMATE_QUALITY_MIN_NODES`
+                        entities. The estimates are returned together with
+                        confidence intervals.
+
+    @param distance_metric  'euclidean', or 'haversine' for great circle
+                        distances in the original space. For 'haversine',
+                        `points[i]` is [lat, lng] in degrees instead, see
+                        `HaversineDistanceMatrix`. This does not support
+                        `distance_storage` or the 'approx' mode, and always
+                        computes the metrics exactly.
+
+    @param context      Optional `SubtreeContext` of the entities, which
+                        provides the distance matrix and the neighbor
+                        candidates of the original space, so that they are
+                        shared between projections. Only used if
+                        `ordering` is a permutation.
+
+    @param context_index  With `context`, an array of shape (l,): the index
+                        of point `i` in the context.
+
+    If `ordering` is a permutation of `0..l-1` (as it is for `quality`),
+    distances, ranks and neighborhoods in the projection are computed in
+    closed form from the positions, see `LinearDistanceMatrix`.
+    '''
+    if mode not in ('exact', 'approx'):
+        raise ValueError(F'Unknown quality mode {mode}')
+    if distance_metric not in ('euclidean', 'haversine'):
+        raise ValueError(F'Unknown distance metric {distance_metric}')
+
+    # plus one so that the last value is <= N/2
+    vec = np.arange(1, min(k_max, len(points)//2 + 1), 1) if k_vec else [min(k_max, len(points)//2)]
+
+    if mode == 'approx' and distance_metric == 'euclidean' and len(points) >= APPROXIMATE_QUALITY_MIN_NODES \
+            and LinearDistanceMatrix.is_applicable(ordering):
+        return dict(**calculate_approximate_quality(points, ordering, vec), quality='approx')
+
+    if len(points) <= 2:
+        # one or two samples: normalized distances should not change
+        M1, M2 = [1], [1]
+        metric_stress = 0
+        nonmetric_stress = 0
+
+    else:
+        points = np.asarray(points)
+
+        if LinearDistanceMatrix.is_applicable(ordering):
+            d_proj = LinearDistanceMatrix(ordering)
+        else:
+            d_proj = DistanceMatrix.from_array(np.column_stack((np.ravel(ordering), np.zeros(len(points)))))
+            context = None
+
+        if context is not None:
+            # the original space is numbered as in the context: the ranks use
+            # the rows `context_index`, the neighbors are renumbered, and the
+            # stress compares both spaces in the numbering of the context
+            d_org = context.distance_matrix(distance_metric)
+            d_org_max = context.max_distance(distance_metric)
+            index_org = np.asarray(context_index)
+
+            labels = np.empty(len(points), dtype=np.int64)
+            labels[index_org] = np.arange(len(points))
+            knn_org = get_canonical_kneighbors(*context.kneighbor_candidates(distance_metric, max(vec)), max(vec),
+                                               labels)[index_org, 1:]
+
+            positions = np.empty(len(points), dtype=np.int64)
+            positions[index_org] = np.ravel(ordering)
+            d_proj_stress = LinearDistanceMatrix(positions).distance_matrix
+
+        else:
+            # calculate distance matrix for rank caluclations
+            if distance_metric == 'haversine':
+                d_org = HaversineDistanceMatrix(points)
+            else:
+                d_org = DistanceMatrix.from_array(points, storage=distance_storage)
+            d_org_max = d_org.distance_matrix.max()
+            index_org, knn_org = None, None
+            d_proj_stress = d_proj.distance_matrix
+
+        d_proj_max = d_proj.distance_matrix.max()
+
+        assert (d_org_max > 0)
+        assert (d_proj_max > 0)
+
+        M1, M2 = calculate_M1_M2(points, ordering, vec, d_org, d_proj, index_org=index_org, knn_org=knn_org)
+        metric_stress = calculate_metric_stress(d_org.distance_matrix, d_proj_stress,
+                                                scale_original=d_org_max, scale_projection=d_proj_max)
+        nonmetric_stress = calculate_nonmetric_stress(d_org.distance_matrix, d_proj_stress)
+
+    if len(M1) == 0:
+        print(points)
+        print(ordering)
+        print(M1, M2)
+
+    return dict(metric_stress=metric_stress, nonmetric_stress=nonmetric_stress, M1=np.mean(M1), M2=np.mean(M2))
 
 
 class Projection:
@@ -21,11 +149,15 @@ class Projection:
     def order(self):
         o = self._order()
         self._point_data = np.zeros(shape=(len(o), 2), dtype=float)
+        self._lat_lng = np.zeros(shape=(len(o), 2), dtype=float)
         self._projection_order = np.ndarray(shape=(len(o),), dtype=int)
+        self._ordered_data = [ point.data for point in o ]
 
         for i, point in enumerate(o):
             self._point_data[i,0] = point.x
             self._point_data[i,1] = point.y
+            self._lat_lng[i,0] = point.data.lat
+            self._lat_lng[i,1] = point.data.lng
             self._projection_order[i] = i  # I just realized we don't really need the initial order anyways
 
         return o
@@ -35,144 +167,541 @@ class Projection:
         return dict()
 
 
-    def _calculate_quality_metrics(self, points, ordering, k_max, k_vec):
+    @classmethod
+    def estimate_cost(cls, n, **kwargs):
         '''
-        Calculate and return quality metrics for the projection.
+        Rough cost of `add_data` for `n` entities with the given `kwargs`, in
+        units of about one distance computation. Only the relative size
+        matters: it is used to schedule the most expensive work first.
+        '''
+        return n * n
 
-        @param points       A numpy.ndarray of shape (l, 2), where `points[i,0]`
-                            is the x coordinate of point `i` (in EPSG3857), and
-                            `points[i,1]` is the y coordinate. `l` is the
-                            number of entities in the projection.
 
-        @param ordering     An array of indices of shape (l,). The order of the
-                            indices is the projection, and the indices
-                            reference the first index in `points`.
+    def _calculate_quality_metrics(self, points, ordering, k_max, k_vec, distance_storage=None, mode='exact',
+            distance_metric='euclidean', context=None, context_index=None):
+        '''
+        See `calculate_quality_metrics`.
+        '''
+        return calculate_quality_metrics(points, ordering, k_max, k_vec, distance_storage, mode, distance_metric,
+                context, context_index)
+
+
+    def quality(self, k_max, k_vec, distance_storage=None, mode='exact', distance_metric='euclidean', context=None):
+        points = self._lat_lng if distance_metric == 'haversine' else self._point_data
+        context_index = context.indices(self._ordered_data) if context is not None else None
+        return self._calculate_quality_metrics(points, self._projection_order, k_max, k_vec,
+                distance_storage=distance_storage, mode=mode, distance_metric=distance_metric,
+                context=context, context_index=context_index)
+
+
+class ProjectedCoordinates:
+    '''
+    EPSG3857 coordinates of every <datum> in a forest, transformed in one
+    vectorized pass and looked up by the datum's `id` (which is unique for
+    all hierarchy levels).
+
+    @param data         <datum>[] forest.
 
-        @param k_max        Maximum `k` for neighborhood graph
+    @raises ValueError  if ids are not unique, or if a datum has coordinates
+                        that do not transform to finite values. All invalid
+                        data are listed in the message.
+    '''
+    def __init__(self, data):
+        forest = []
+        stack = list(data)
+        while len(stack) > 0:
+            datum = stack.pop()
+            forest.append(datum)
+            if datum.children is not None:
+                stack.extend(datum.children)
+
+        self.index = { datum.id: i for i, datum in enumerate(forest) }
+        if len(self.index) != len(forest):
+            raise ValueError('Datum ids are not unique')
+
+        lat = np.array([ np.nan if d.lat is None else d.lat for d in forest ], dtype=float)
+        lng = np.array([ np.nan if d.lng is None else d.lng for d in forest ], dtype=float)
+
+        crs = CRS.from_epsg(3857)
+        transformer = Transformer.from_crs(crs.geodetic_crs, crs, always_xy=True)
+        self.x, self.y = (np.asarray(c, dtype=float) for c in transformer.transform(lng, lat))
+        self._cache = dict()
 
-        @param k_vec        Boolean: True -> use mean of multiple measurements
-                            with different `k`
+        _validate_coordinates(forest, self.x, self.y)
+
+
+    @classmethod
+    def from_arrays(cls, ids, x, y):
+        '''
+        Coordinates that were already transformed, e.g., those of a `SharedForest`.
         '''
-        if len(points) <= 2:
-            # one or two samples: normalized distances should not change
-            M1, M2 = [1], [1]
-            metric_stress = 0
-            nonmetric_stress = 0
+        coordinates = cls.__new__(cls)
+        coordinates.index = { id: i for i, id in enumerate(ids) }
+        coordinates.x = np.array(x, dtype=float)
+        coordinates.y = np.array(y, dtype=float)
+        coordinates._cache = dict()
+        return coordinates
 
-        else:
-            data, data_proj = points_ordering_to_wildfire_structure(points, ordering)
 
-            # calculate distance matrix for rank caluclations
-            d_org = wrapper_for_d_matrix_calculation(data)
-            d_proj = wrapper_for_d_matrix_calculation(data_proj)
+    def cached(self, key, function):
+        '''
+        Returns `function()`, which is only called the first time for `key`,
+        for results about the whole forest (see `SubtreeContext.cached`).
+        '''
+        if key not in self._cache:
+            self._cache[key] = function()
+        return self._cache[key]
 
-            d_org_max = np.max(d_org.distance_matrix)
-            d_proj_max = np.max(d_proj.distance_matrix)
 
-            assert (d_org_max > 0)
-            assert (d_proj_max > 0)
+    def indices(self, data):
+        '''
+        The index in `x` and `y` of each <datum> in `data`.
+        '''
+        return np.fromiter((self.index[d.id] for d in data), dtype=np.int64, count=len(data))
 
-            # plus one so that the last value is <= N/2
-            vec = np.arange(1, min(k_max, len(points)//2 + 1), 1) if k_vec else [min(k_max, len(points)//2)]
 
-            M1, M2 = calculate_M1_M2_score(data, data_proj, d_org, d_proj, vec)
-            metric_stress = calculate_metric_stress(d_org.distance_matrix/d_org_max, d_proj.distance_matrix/d_proj_max)
-            nonmetric_stress = calculate_nonmetric_stress(d_org.distance_matrix, d_proj.distance_matrix)
+    def x_of(self, datum):
+        return self.x[self.index[datum.id]]
 
-        if len(M1) == 0:
-            print(points)
-            print(ordering)
-            print(M1, M2)
 
-        return dict(metric_stress=metric_stress, nonmetric_stress=nonmetric_stress, M1=np.mean(M1), M2=np.mean(M2))
+    def y_of(self, datum):
+        return self.y[self.index[datum.id]]
 
 
-    def quality(self, k_max, k_vec):
-        return self._calculate_quality_metrics(self._point_data, self._projection_order, k_max, k_vec)
+    def xy(self, data):
+        '''
+        The coordinates of a list of <datum> as a numpy.ndarray of shape
+        (len(data), 2).
+        '''
+        indices = self.indices(data)
+        return np.column_stack((self.x[indices], self.y[indices]))
+
+
+def _validate_coordinates(data, x, y):
+    invalid = np.flatnonzero(~(np.isfinite(x) & np.isfinite(y)))
+    if len(invalid) > 0:
+        details = ''.join([ F'\n  {data[i].name}  {data[i].lat} {data[i].lng}' for i in invalid ])
+        raise ValueError(F'Points with invalid coordinates:{details}')
 
 
 class GeospatialProjection(Projection):
-    def __init__(self):
+    def __init__(self, coordinates=None):
+        '''
+        @param coordinates  Optional `ProjectedCoordinates` of the forest, so
+                            that the data need not be transformed again.
+        '''
         super().__init__()
 
         crs = CRS.from_epsg(3857)
         self.proj = Transformer.from_crs(crs.geodetic_crs, crs, always_xy=True)
+        self.coordinates = coordinates
 
-        self.x_fn = lambda datum: self.proj.transform(datum.lng, datum.lat, errcheck=True)[0]
-        self.y_fn = lambda datum: self.proj.transform(datum.lng, datum.lat, errcheck=True)[1]
+        if coordinates is not None:
+            self.x_fn = coordinates.x_of
+            self.y_fn = coordinates.y_of
+        else:
+            self.x_fn = lambda datum: self.proj.transform(datum.lng, datum.lat, errcheck=True)[0]
+            self.y_fn = lambda datum: self.proj.transform(datum.lng, datum.lat, errcheck=True)[1]
+
+
+    def xy(self, data, context=None):
+        '''
+        The EPSG3857 coordinates of a list of <datum> as a numpy.ndarray of
+        shape (len(data), 2). With the `SubtreeContext` of `data`, they are
+        taken from the context.
+
+        @raises ValueError  if coordinates are not finite.
+        '''
+        if context is not None:
+            return context.xy
+        if self.coordinates is not None:
+            return self.coordinates.xy(data)
+
+        lat = np.array([ np.nan if d.lat is None else d.lat for d in data ], dtype=float)
+        lng = np.array([ np.nan if d.lng is None else d.lng for d in data ], dtype=float)
+        x, y = (np.asarray(c, dtype=float) for c in self.proj.transform(lng, lat))
+        _validate_coordinates(data, x, y)
+
+        return np.column_stack((x, y))
 
 
     def metadata(self):
-        x0 = self.quadtree.root.x0
-        y0 = self.quadtree.root.y0
-        x1 = self.quadtree.root.x1
-        y1 = self.quadtree.root.y1
+        '''
+        The `grid_cell` of the square around the points of `order`, as for
+        the `SpaceFillingCurveProjection` classes.
+        '''
+        return dict(grid_cell=grid_cell(*squarified_bounds(self._point_data)))
+
+
+def grid_cell(x0, y0, x1, y1):
+    '''
+    The corners of an EPSG3857 rectangle as `{lat, lng}` objects, counter-
+    clockwise from `(x0, y0)`: the `grid_cell` metadata of the quadtree
+    based projections.
+    '''
+    points = _epsg3857().transform(
+            [x0, x0, x1, x1],
+            [y0, y1, y1, y0],
+            direction=TransformDirection.INVERSE
+            )
+
+    return [ {"lat": p[1], "lng": p[0] } for p in zip(*points) ]
 
-        points = self.proj.transform(
-                [x0, x0, x1, x1],
-                [y0, y1, y1, y0],
-                direction=TransformDirection.INVERSE
-                )
 
-        pts = [ {"lat": p[1], "lng": p[0] } for p in zip(*points) ]
-        return dict(grid_cell=pts)
+@lru_cache(maxsize=None)
+def _epsg3857():
+    crs = CRS.from_epsg(3857)
+    return Transformer.from_crs(crs.geodetic_crs, crs, always_xy=True)
 
 
-def create_projection(projection_class, data, key=None, name=None, description=None, k_max=5, k_vec=True, **kwargs):
+class ArrayProjection:
     '''
-    Create a <projection> object from a <datum>[] forest.
+    A projection of arrays: `add_data` gets the coordinates (and, if
+    `uses_timeseries`, the time series) of the entities, and `order` returns
+    the projection as a permutation of their indices.
+
+    Projections written against <datum> objects and `Point` lists (subclasses
+    of `Projection`) are used through `PointProjectionAdapter`.
     '''
-    if key is None:
-        key = projection_class.__name__
+    # if True, add_data gets the `timeseries` of the `tsfunc` and `tslen` in the kwargs of the projection
+    uses_timeseries = False
+
+    # subtrees with at most this many entities take the fast path of add_trivial_data instead of add_data
+    trivial_size = 1
+
+
+    def add_data(self, xy, ids=None, timeseries=None, context=None, **kwargs):
+        '''
+        @param xy           numpy.ndarray of shape (n, 2) with the EPSG3857
+                            coordinates of the entities.
+
+        @param ids          The ids of the entities.
+
+        @param timeseries   numpy.ndarray of shape (n, tslen), or None.
+
+        @param context      Optional `SubtreeContext` of the entities, to
+                            share intermediate results between projections.
+        '''
+        pass
+
+
+    def add_trivial_data(self, xy, **kwargs):
+        '''
+        Used instead of `add_data` for at most `trivial_size` entities: sets
+        `permutation` to the order that `add_data` would create, without
+        setting up the projection. `kwargs` are those of `add_data`.
+        '''
+        self.kwargs = kwargs
+        self.permutation = np.arange(len(xy))
 
-    per_level = dict()
-    # get root level order
 
-    p = projection_class()
-    p.add_data(data, **kwargs)
-    root_order = list(map(lambda x: x.data.id, p.order()))
-    slo = {
-            '@@ROOT@@': SubtreeLevelOrder(order=root_order, **p.metadata(), **p.quality(k_max, k_vec))
-        }
-    per_level[0] = slo
+    def order(self):
+        '''
+        numpy.ndarray of shape (n,): `order()[i]` is the index of the entity at
+        position `i` of the projection.
+        '''
+        return self.permutation
+
+
+    def metadata(self):
+        return dict()
+
+
+    def cache_inputs(self, context, **kwargs):
+        '''
+        Anything besides the entities of the subtree and the kwargs that the
+        order depends on (e.g., the extent of the forest), for the keys of an
+        `OrderCache`, or None. `kwargs` are those of `add_data`.
+        '''
+        return None
+
+
+    @classmethod
+    def estimate_cost(cls, n, **kwargs):
+        '''
+        See `Projection.estimate_cost`.
+        '''
+        return n * n
 
-    # others
-    for child in data:
-        if child.children is not None and len(child.children) > 0:
-            _create_recursive_level_orders(projection_class, child, 1, per_level, k_max, k_vec, **kwargs)
-        elif child.children is not None and len(child.children) == 0:
-            logging.warn('    Subtree %s has empty child array.', child.name)
 
-    per_level = [ PerLevelOrders(**per_level[idx]) for idx in range(len(per_level)) ]
+class SpaceFillingCurveProjection(ArrayProjection):
+    '''
+    Orders the entities along a space-filling curve, refined until each
+    entity has its own cell (the order of a traversal of their quadtree).
+    Subclasses implement `curve_ranks`.
+
+    With `curve='local'`, the curve runs through the square around the
+    entities of each subtree. With `curve='global'`, it runs through the
+    square around the whole forest: the ranks of all <datum> are computed
+    once (per `ProjectedCoordinates`), and the order of each subtree is the
+    order of their ranks. Orders differ from the local ones where the
+    subtree is small compared to the forest and the global cells split it
+    differently. The `grid_cell` metadata is the square around the subtree
+    in both cases.
+    '''
+    def add_data(self, xy, ids=None, timeseries=None, context=None, curve='local'):
+        self.bounds = squarified_bounds(xy)
+
+        if curve == 'local':
+            ranks = self.curve_ranks(xy, self.bounds)
+        elif curve == 'global':
+            if context is None:
+                raise ValueError(F'{type(self).__name__} needs the SubtreeContext of its data for the global curve')
+            coordinates = context.coordinates
+            ranks = self._global_ranks(coordinates)[coordinates.indices(context.data)]
+        else:
+            raise ValueError(F'Unknown curve {curve!r}')
 
-    # create total ordering
-    total_order = []
-    def _do_total(sequence, depth):
-        for item in sequence:
-            total_order.append(item)
+        self.permutation = np.argsort(ranks, kind='stable')
 
-            if depth >= len(per_level):
-                continue
 
-            if item in per_level[depth].__dict__:
-                _do_total(per_level[depth].__dict__[item].order, depth+1)
-    _do_total(root_order, 1)
+    def add_trivial_data(self, xy, **kwargs):
+        super().add_trivial_data(xy, **kwargs)
+        self.bounds = squarified_bounds(xy)
 
-    return ProjectionData(key=key, name=name, description=description, total_order=total_order, per_level=per_level)
 
+    def curve_ranks(self, xy, bounds):
+        '''
+        The position of each of the points `xy` on the curve through the
+        square `bounds`, with the same rank for identical points, see
+        `util.spacefillingcurves`.
+        '''
+        raise NotImplementedError
 
-def _create_recursive_level_orders(projection_class, subtree, depth, per_level, k_max, k_vec, **kwargs):
-    p = projection_class()
-    p.add_data(subtree.children, **kwargs)
-    order = SubtreeLevelOrder(order=list(map(lambda x: x.data.id, p.order())), **p.metadata(), **p.quality(k_max, k_vec))
 
-    if depth not in per_level:
-        per_level[depth] = dict()
-    per_level[depth].update({subtree.id: order})
+    def cache_inputs(self, context, curve='local', **kwargs):
+        if curve == 'global':
+            return _global_bounds(context.coordinates)
+        return None
 
-    for child in subtree.children:
-        if child.children is not None and len(child.children) > 0:
-            _create_recursive_level_orders(projection_class, child, depth+1, per_level, k_max, k_vec, **kwargs)
-        elif child.children is not None and len(child.children) == 0:
-            logging.warn('    Subtree %s has empty child array.', child.name)
 
+    def _global_ranks(self, coordinates):
+        return coordinates.cached(('curve_ranks', type(self)),
+                lambda: self.curve_ranks(np.column_stack((coordinates.x, coordinates.y)), _global_bounds(coordinates)))
+
+
+    def metadata(self):
+        return dict(grid_cell=grid_cell(*self.bounds))
+
+
+    @classmethod
+    def estimate_cost(cls, n, **kwargs):
+        return n * max(math.log2(n), 1)
+
+
+def _global_bounds(coordinates):
+    return coordinates.cached('curve_bounds',
+            lambda: squarified_bounds(np.column_stack((coordinates.x, coordinates.y))))
+
+
+class PointProjectionAdapter(ArrayProjection):
+    '''
+    `ArrayProjection` interface for a `Projection`, which orders the <datum>
+    of the `context` that `add_data` requires.
+    '''
+    # the Point-based projections have no fast path
+    trivial_size = 0
+
+
+    def __init__(self, projection):
+        self.projection = projection
+
+
+    def add_data(self, xy, ids=None, timeseries=None, context=None, **kwargs):
+        if context is None:
+            raise ValueError(F'{type(self.projection).__name__} needs the SubtreeContext of its data')
+
+        self.context = context
+        if _accepts(self.projection.add_data, 'context'):
+            kwargs['context'] = context
+        self.projection.add_data(context.data, **kwargs)
+
+
+    def order(self):
+        return self.context.indices([ point.data for point in self.projection.order() ])
+
+
+    def metadata(self):
+        return self.projection.metadata()
+
+
+def _accepts(function, name):
+    # whether `function` takes the keyword argument `name`, which projections written before it was added do not
+    parameters = inspect.signature(function).parameters
+    return name in parameters or any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values())
+
+
+def fast_path_size(projection_class):
+    '''
+    Subtrees with up to this many children take the fast path of
+    `ArrayProjection.add_trivial_data`.
+    '''
+    return projection_class.trivial_size if issubclass(projection_class, ArrayProjection) else 0
+
+
+# time series of an ArrayProjection without a `tsfunc`, as for the `Projection` classes
+_DEFAULT_TSFUNC = attrgetter('data')
+
+
+def timeseries_input(projection_class, kwargs):
+    '''
+    `(tsfunc, tslen)` of the time series that a projection with `kwargs`
+    uses, or None if it uses none. For `Projection` classes, the defaults are
+    those of their `add_data`.
+    '''
+    if issubclass(projection_class, ArrayProjection):
+        if not projection_class.uses_timeseries:
+            return None
+        return kwargs.get('tsfunc', _DEFAULT_TSFUNC), kwargs.get('tslen', 1)
+
+    parameters = inspect.signature(projection_class.add_data).parameters
+    if 'tsfunc' not in parameters:
+        return None
+    return kwargs.get('tsfunc', parameters['tsfunc'].default), \
+        kwargs.get('tslen', parameters['tslen'].default if 'tslen' in parameters else 1)
+
+
+def as_array_projection(projection_class, coordinates=None):
+    '''
+    An instance of `projection_class` with the `ArrayProjection` interface.
+    '''
+    if issubclass(projection_class, ArrayProjection):
+        return projection_class()
+    if _accepts(projection_class, 'coordinates'):
+        return PointProjectionAdapter(projection_class(coordinates))
+    return PointProjectionAdapter(projection_class())
+
+
+def create_subtree_level_order(projection, context, k_max=5, k_vec=True, distance_storage=None, quality='exact',
+        distance_metric='euclidean', tracer=NULL_TRACER, cache=None, **kwargs):
+    '''
+    Order the <datum> of a `SubtreeContext` with an `ArrayProjection`, and
+    return the `SubtreeLevelOrder` with its metadata and quality metrics.
+
+    The stages are recorded as spans of `tracer`. With an `OrderCache`
+    `cache`, a cached result is returned instead, and new results are added
+    to it. Projections with the same order of the same context share their
+    quality metrics. The other parameters are those of `create_projection`.
+    '''
+    projection_class = type(projection.projection) if isinstance(projection, PointProjectionAdapter) \
+        else type(projection)
+
+    timeseries = None
+    tsinput = timeseries_input(projection_class, kwargs)
+    if tsinput is not None and (projection.uses_timeseries or cache is not None):
+        timeseries = context.timeseries(*tsinput)
+
+    if cache is not None:
+        with tracer.span('cache'):
+            settings = dict(k_max=k_max, k_vec=k_vec, distance_storage=distance_storage, quality=quality,
+                    distance_metric=distance_metric)
+            inputs = projection.cache_inputs(context, **kwargs)
+            if inputs is not None:
+                settings.update(inputs=inputs)
+            key = cache.key(projection_class, context, kwargs, timeseries, **settings)
+            cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    if projection.uses_timeseries:
+        kwargs.pop('tsfunc', None)
+        kwargs.pop('tslen', None)
+    else:
+        timeseries = None
+
+    if len(context.data) <= projection.trivial_size:
+        with tracer.span('add_trivial_data'):
+            projection.add_trivial_data(context.xy, **kwargs)
+    else:
+        with tracer.span('add_data'):
+            projection.add_data(context.xy, ids=context.ids, timeseries=timeseries, context=context, **kwargs)
+    with tracer.span('order'):
+        permutation = np.asarray(projection.order(), dtype=np.int64)
+        order = [ context.ids[i] for i in permutation ]
+
+    # the quality metrics see the points in projection order, at positions 0..n-1
+    def _quality():
+        points = context.lat_lng if distance_metric == 'haversine' else context.xy
+        return calculate_quality_metrics(points[permutation], np.arange(len(permutation)), k_max, k_vec,
+                distance_storage, quality, distance_metric, context=context, context_index=permutation)
+
+    with tracer.span('quality'):
+        metrics = dict(context.cached(('quality', permutation.tobytes(), k_max, bool(k_vec), quality,
+                distance_metric), _quality))
+
+    result = SubtreeLevelOrder(order=order, **projection.metadata(), **metrics)
+    if cache is not None:
+        cache.put(key, result)
+
+    return result
+
+
+def create_projection(projection_class, data, key=None, name=None, description=None, k_max=5, k_vec=True,
+        distance_storage=None, quality='exact', distance_metric='euclidean', coordinates=None, tracer=NULL_TRACER,
+        cache=None, sink=None, **kwargs):
+    '''
+    Create a <projection> object from a <datum>[] forest.
+
+    `projection_class` is an `ArrayProjection` or a `Projection`.
+    `distance_storage` optionally sets the `DistanceStorage` used for the
+    distance matrices of the quality metrics. With `quality='approx'`, the
+    quality metrics of large subtrees are estimated from samples. With
+    `distance_metric='haversine'`, the quality metrics use great circle
+    distances between the lat/lng coordinates instead of Euclidean distances
+    in EPSG3857.
+
+    `coordinates` are the `ProjectedCoordinates` of `data`. They are computed
+    if not given, pass them in to share them between projections.
+
+    The stages of each subtree are recorded as spans of the `Tracer` `tracer`.
+    With an `OrderCache` `cache`, the orders of subtrees whose inputs have
+    not changed are read from it.
+
+    The subtrees are ordered level by level, and each `SubtreeLevelOrder` is
+    passed to the `LevelOrderSink` `sink` as soon as it is finished. With a
+    `SpillSink`, they are kept on disk instead of in memory, and a
+    `SpilledProjection` is returned.
+    '''
+    if key is None:
+        key = projection_class.__name__
+    if coordinates is None:
+        coordinates = ProjectedCoordinates(data)
+    if sink is None:
+        sink = LevelOrderSink()
+
+    size, fast_path, count = fast_path_size(projection_class), 0, 0
+    for index, (depth, parent_id, children) in enumerate(iter_subtrees(data)):
+        p = as_array_projection(projection_class, coordinates)
+        order = create_subtree_level_order(p, SubtreeContext(children, coordinates, distance_storage), k_max,
+                k_vec, distance_storage, quality, distance_metric,
+                tracer.bind(projection=key, subtree=parent_id, n=len(children)), cache, **kwargs)
+        sink.add(key, index, depth, parent_id, order)
+        fast_path += len(children) <= size
+        count += 1
+
+    logging.info('  Created projection %s (%d of %d subtrees on the fast path).', key, fast_path, count)
+
+    return sink.projection(key, name, description)
+
+
+def iter_subtrees(data):
+    '''
+    `(depth, parent id, children)` of the root level (`@@ROOT@@`, depth 0) and
+    of each <datum> of a forest with children, level by level, without
+    recursion. Within a level, the subtrees are in pre-order.
+    '''
+    level = [ ('@@ROOT@@', data) ]
+    depth = 0
+    while len(level) > 0:
+        next_level = []
+        for parent_id, children in level:
+            yield depth, parent_id, children
+
+            for child in children:
+                if child.children is not None and len(child.children) > 0:
+                    next_level.append((child.id, child.children))
+                elif child.children is not None and len(child.children) == 0:
+                    logging.warn('    Subtree %s has empty child array.', child.name)
+
+        level = next_level
+        depth += 1
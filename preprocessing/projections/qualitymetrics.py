@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from math import sqrt
 
 import geopandas as gpd
@@ -5,15 +6,17 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas as pd
-import scipy.stats as ss
-from sklearn.isotonic import IsotonicRegression
+import scipy.sparse as sp
+from sklearn.isotonic import isotonic_regression
 from sklearn.metrics import pairwise_distances
-from sklearn.neighbors import NearestNeighbors
+from sklearn.neighbors import BallTree, NearestNeighbors
+
+from projections.distancestorage import CondensedDistances, _condensed_offset
 
 
 # distance functions from https://github.com/mie-lab/trackintel/blob/master/trackintel/geogr/distances.py
 
-def calculate_distance_matrix(points, dist_metric='haversine', n_jobs=None, *args, **kwds):
+def calculate_distance_matrix(points, dist_metric='haversine', n_jobs=None, storage=None, *args, **kwds):
     """
     Calculate a distance matrix based on a specific distance metric.
     Parameters
@@ -24,6 +27,9 @@ def calculate_distance_matrix(points, dist_metric='haversine', n_jobs=None, *arg
         The distance metric to be used for caltulating the matrix.
     n_jobs : int, optional
         Number of jobs to be passed to the ``sklearn.metrics`` function ``pairwise_distances``.
+    storage : DistanceStorage, optional
+        If given, the matrix is computed block by block into the layout, precision
+        and (memory-mapped) backing specified by the storage.
     *args
         Description
     **kwds
@@ -32,7 +38,8 @@ def calculate_distance_matrix(points, dist_metric='haversine', n_jobs=None, *arg
     Returns
     -------
     array
-        An array of size [n_points, n_points].
+        An array of size [n_points, n_points], or a ``CondensedDistances`` for the
+        condensed storage layout.
     """
 
     try:
@@ -42,6 +49,9 @@ def calculate_distance_matrix(points, dist_metric='haversine', n_jobs=None, *arg
         x = points.geometry.x.values
         y = points.geometry.y.values
 
+    if storage is not None:
+        return storage.create(len(x), lambda i0, i1: _calculate_distance_rows(x, y, i0, i1, dist_metric))
+
     if dist_metric == 'euclidean':
         xy = np.concatenate((x.reshape(-1, 1), y.reshape(-1, 1)), axis=1)
         D = pairwise_distances(xy, n_jobs=n_jobs)
@@ -77,6 +87,32 @@ def calculate_distance_matrix(points, dist_metric='haversine', n_jobs=None, *arg
     return D
 
 
+def _calculate_distance_rows(x, y, i0, i1, dist_metric):
+    """
+    Distances of points `i0..i1-1` to all points, as an array of shape
+    (i1 - i0, n_points). Unlike the dense code path, Euclidean distances are
+    computed from the coordinate differences, so the result is exactly
+    symmetric between blocks.
+    """
+    x0 = x[i0:i1].astype(float)[:, np.newaxis]
+    y0 = y[i0:i1].astype(float)[:, np.newaxis]
+
+    if dist_metric == 'euclidean':
+        D = np.sqrt((x0 - x[np.newaxis, :]) ** 2 + (y0 - y[np.newaxis, :]) ** 2)
+
+    elif dist_metric == 'haversine':
+        shape = (i1 - i0, len(x))
+        D = haversine_dist(np.broadcast_to(x0, shape), np.broadcast_to(y0, shape),
+                           np.broadcast_to(x, shape), np.broadcast_to(y, shape)).reshape(shape)
+        D[np.arange(i1 - i0), np.arange(i0, i1)] = 0
+
+    else:
+        xy = np.concatenate((x.reshape(-1, 1), y.reshape(-1, 1)), axis=1)
+        D = pairwise_distances(xy[i0:i1], xy, metric=dist_metric)
+
+    return D
+
+
 def haversine_dist(lon_1, lat_1, lon_2, lat_2, r=6371000):
     """Computes the great circle or haversine distance between two coordinates in WGS84.
     # todo: test different input formats, especially different vector
@@ -241,13 +277,162 @@ def get_graph_from_fire_data(data, k=5, distance_metric='euclidean'):
     G = create_graph_representation(data, nbrs_dict, distance_metric=distance_metric)
     return G
 
+# approximate number of matrix entries processed at once by calculate_metric_stress
+STRESS_BLOCK_ELEMENTS = 2**22
+
+# above this many nodes, RankMatrix only keeps a bounded number of rows
+RANK_MATRIX_MAX_NODES = 10000
+RANK_MATRIX_MAX_ROWS = 1024
+
+
+def calculate_doubled_ranks(distances):
+    """
+    Rank every row of `distances` in one argsort pass.
+
+    Ties get the average rank, as in `scipy.stats.rankdata`. Since the average
+    rank of a tie group is a multiple of 0.5, the ranks are returned doubled
+    (as int64), so that they can be stored in an integer array without loss.
+
+    Parameters
+    ----------
+    distances : numpy.ndarray of shape (m, N)
+
+    Returns
+    -------
+    numpy.ndarray of shape (m, N) with `2 * rank`.
+    """
+    m, n = distances.shape
+    order = np.argsort(distances, axis=1, kind='stable')
+    sorted_distances = np.take_along_axis(distances, order, axis=1)
+
+    # a tie group starts where the sorted value changes and ends before the next start
+    group_start = np.ones((m, n), dtype=bool)
+    group_start[:, 1:] = sorted_distances[:, 1:] != sorted_distances[:, :-1]
+    group_end = np.ones((m, n), dtype=bool)
+    group_end[:, :-1] = group_start[:, 1:]
+
+    positions = np.arange(n)
+    first = np.maximum.accumulate(np.where(group_start, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(group_end, positions, n - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    # ranks are 1-based: 2 * ((first + 1) + (last + 1)) / 2
+    doubled = np.empty((m, n), dtype=np.int64)
+    np.put_along_axis(doubled, order, first + last + 2, axis=1)
+
+    return doubled
+
+
+class RankMatrix():
+    """
+    Distance ranks of all nodes relative to each reference node.
+
+    Row `i` holds the (doubled) rank of every node in column `i` of the
+    distance matrix, stored as uint16 if N allows and as int32 otherwise. For
+    up to `max_rows` nodes, all rows are computed up front. Otherwise, only
+    the most recently used `max_rows` rows are kept in an LRU cache.
+    """
+    def __init__(self, distance_matrix, max_rows=None, block_size=256):
+        self.distance_matrix = distance_matrix
+        self.n = distance_matrix.shape[0]
+        self.dtype = np.uint16 if 2 * self.n <= np.iinfo(np.uint16).max else np.int32
+        self.block_size = block_size
+
+        if max_rows is None:
+            max_rows = self.n if self.n <= RANK_MATRIX_MAX_NODES else RANK_MATRIX_MAX_ROWS
+        self.max_rows = max(1, max_rows)
+
+        if self.max_rows >= self.n:
+            self.ranks = np.empty((self.n, self.n), dtype=self.dtype)
+            for i0 in range(0, self.n, block_size):
+                i1 = min(i0 + block_size, self.n)
+                self.ranks[i0:i1] = self._calculate_rows(np.arange(i0, i1))
+            self.cache = None
+        else:
+            self.ranks = None
+            self.cache = OrderedDict()
+
+    def _calculate_rows(self, references):
+        return calculate_doubled_ranks(self.distance_matrix[:, references].T).astype(self.dtype)
+
+    def row(self, reference):
+        """
+        Returns the ranks of all nodes relative to the node at matrix index
+        `reference`.
+        """
+        if self.cache is None:
+            return self.ranks[reference] / 2
+
+        self._fetch(np.array([reference]))
+        return self.cache[reference] / 2
+
+    def _fetch(self, references):
+        missing = [ r for r in references if r not in self.cache ]
+        for i0 in range(0, len(missing), self.block_size):
+            block = missing[i0:i0 + self.block_size]
+            for r, ranks in zip(block, self._calculate_rows(block)):
+                self.cache[r] = ranks
+
+        for r in references:
+            self.cache.move_to_end(r)
+        while len(self.cache) > self.max_rows:
+            self.cache.popitem(last=False)
+
+    def get(self, reference_indices, ranked_indices):
+        """
+        Returns an array where entry `i` is the rank of `ranked_indices[i]`
+        relative to `reference_indices[i]`.
+        """
+        reference_indices = np.asarray(reference_indices)
+        ranked_indices = np.asarray(ranked_indices)
+
+        if self.cache is None:
+            return self.ranks[reference_indices, ranked_indices] / 2
+
+        ranks = np.empty(reference_indices.shape, dtype=float)
+
+        # handle at most `max_rows` reference nodes at a time, so they all fit the cache
+        order = np.argsort(reference_indices, kind='stable')
+        references, starts = np.unique(reference_indices[order], return_index=True)
+        ends = np.append(starts[1:], order.size)
+
+        for c0 in range(0, len(references), self.max_rows):
+            chunk = references[c0:c0 + self.max_rows]
+            self._fetch(chunk)
+
+            for reference, start, end in zip(chunk, starts[c0:c0 + self.max_rows], ends[c0:c0 + self.max_rows]):
+                idx = order[start:end]
+                ranks[idx] = self.cache[reference][ranked_indices[idx]] / 2
+
+        return ranks
+
+
 class DistanceMatrix():
-    def __init__(self, points, distance_metric='euclidean'):
-        self.distance_matrix = calculate_distance_matrix(points, dist_metric=distance_metric)
+    def __init__(self, points, distance_metric='euclidean', max_rank_rows=None, storage=None):
+        self.distance_matrix = calculate_distance_matrix(points, dist_metric=distance_metric, storage=storage)
         self.matrix_index_to_node_id = points.reset_index()['name']
         self.node_id_to_matrix_index = pd.Series(self.matrix_index_to_node_id.index.values,
                                                  index=self.matrix_index_to_node_id)
-        self.sorted_ranking_cache = {}
+        self._node_id_to_matrix_index = dict(zip(self.matrix_index_to_node_id, range(len(self.matrix_index_to_node_id))))
+        self.max_rank_rows = max_rank_rows
+        self._rank_matrix = None
+
+    @classmethod
+    def from_array(cls, points, distance_metric='euclidean', max_rank_rows=None, storage=None):
+        """
+        Create a DistanceMatrix from a numpy.ndarray of shape (N, 2). The node
+        ids are the row indices of `points`.
+        """
+        df = pd.DataFrame(dict(name=np.arange(len(points)), x=points[:, 0], y=points[:, 1]))
+        df.set_index('name', inplace=True)
+
+        return cls(df, distance_metric=distance_metric, max_rank_rows=max_rank_rows, storage=storage)
+
+    @property
+    def rank_matrix(self):
+        # only computed once ranks are actually needed
+        if self._rank_matrix is None:
+            self._rank_matrix = RankMatrix(self.distance_matrix, max_rows=self.max_rank_rows)
+        return self._rank_matrix
 
     def get_ranking_from_node_id(self, node_id):
         """
@@ -255,14 +440,9 @@ class DistanceMatrix():
 
         """
 
-        matrix_index = self.node_id_to_matrix_index[node_id]
-        distances = self.distance_matrix[:, matrix_index]
+        matrix_index = self._node_id_to_matrix_index[node_id]
 
-        ranks = ss.rankdata(distances)
-
-        self.sorted_ranking_cache = {node_id: ranks}
-
-        return ranks
+        return self.rank_matrix.row(matrix_index)
 
     def return_node_rank_specific_to_node(self, reference_node, node_to_be_ranked):
         """
@@ -271,17 +451,206 @@ class DistanceMatrix():
         E.g, the node_to_be_ranked is the 10th closest node to the reference_node
         """
 
-        # get ranking
-        if reference_node in self.sorted_ranking_cache:
-            ranks = self.sorted_ranking_cache[reference_node]
+        reference_matrix_id = self._node_id_to_matrix_index[reference_node]
+        node_to_be_ranked_matrix_id = self._node_id_to_matrix_index[node_to_be_ranked]
+
+        return self.rank_matrix.get([reference_matrix_id], [node_to_be_ranked_matrix_id])[0]
+
+    def get_ranks_by_matrix_index(self, reference_indices, ranked_indices):
+        """
+        Vectorized counterpart of `return_node_rank_specific_to_node`, operating
+        on matrix indices instead of node ids.
+
+        Returns an array where entry `i` is the rank of `ranked_indices[i]`
+        relative to `reference_indices[i]`. Ties get the average rank, as in
+        `scipy.stats.rankdata`.
+        """
+        return self.rank_matrix.get(reference_indices, ranked_indices)
+
+
+class LinearDistances():
+    """
+    Read-only, array-like view of the distance matrix of a 1D projection,
+    `D[i, j] = |positions[i] - positions[j]|`, computed on access. Supports
+    the indexing used by the stress functions: two slices (a dense block) or
+    two index arrays (element-wise pairs), and division by a scalar.
+    """
+    def __init__(self, positions, scale=1.0):
+        self.positions = positions
+        self.scale = scale
+        self.shape = (len(positions), len(positions))
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            distances = np.abs(self.positions[rows][:, np.newaxis] - self.positions[cols][np.newaxis, :])
+        else:
+            distances = np.abs(self.positions[rows] - self.positions[cols])
+
+        return distances * self.scale
+
+    def __truediv__(self, divisor):
+        return LinearDistances(self.positions, self.scale / divisor)
+
+    def max(self):
+        return (np.max(self.positions) - np.min(self.positions)) * self.scale
+
+
+class LinearDistanceMatrix():
+    """
+    Counterpart of `DistanceMatrix` for the projected side of a 1D projection,
+    where `positions` is a permutation of `0..N-1`. Distances, ranks and
+    k-neighborhoods follow in closed form from the positions, so that neither
+    the dense distance matrix nor a kNN search is needed. Node ids are the
+    indices into `positions`.
+    """
+    def __init__(self, positions):
+        self.positions = np.asarray(positions, dtype=np.int64).ravel()
+        self.n = len(self.positions)
+        self.distance_matrix = LinearDistances(self.positions)
+
+        self.index_at_position = np.empty(self.n, dtype=np.int64)
+        self.index_at_position[self.positions] = np.arange(self.n)
+
+    @staticmethod
+    def is_applicable(ordering):
+        """
+        True if `ordering` is a permutation of `0..N-1`.
+        """
+        positions = np.ravel(ordering)
+        return np.array_equal(np.sort(positions), np.arange(len(positions)))
+
+    def get_ranks_by_matrix_index(self, reference_indices, ranked_indices):
+        """
+        Same as `DistanceMatrix.get_ranks_by_matrix_index`: the rank of node
+        `ranked_indices[i]` relative to `reference_indices[i]`, where ties get
+        the average rank.
+        """
+        reference = self.positions[np.asarray(reference_indices)]
+        distance = np.abs(self.positions[np.asarray(ranked_indices)] - reference)
+
+        # nodes closer than `distance` lie strictly between `low` and `high`
+        low = reference - distance
+        high = reference + distance
+        smaller = np.minimum(high - 1, self.n - 1) - np.maximum(low + 1, 0) + 1
+        equal = (low >= 0).astype(np.int64) + (high <= self.n - 1)
+
+        # only the node itself has distance 0
+        smaller = np.where(distance == 0, 0, smaller)
+        equal = np.where(distance == 0, 1, equal)
+
+        return smaller + (equal + 1) / 2
+
+    def get_knn_indices(self, k):
+        """
+        Same as `get_knn_indices` on the projected points: the `k-1` nearest
+        neighbors of each node, excluding the node itself, in the same
+        canonical order: of two neighbors at the same distance (one on each
+        side), the one with the lower index is taken first.
+        """
+        offsets = np.concatenate((np.arange(-(k - 1), 0), np.arange(1, k)))
+        candidates = self.positions[:, np.newaxis] + offsets[np.newaxis, :]
+        valid = (candidates >= 0) & (candidates < self.n)
+
+        neighbors = self.index_at_position[np.where(valid, candidates, 0)]
+        distance = np.where(valid, np.abs(offsets)[np.newaxis, :], self.n)
+
+        order = np.argsort(distance * self.n + neighbors, axis=1, kind='stable')
+
+        return np.take_along_axis(neighbors, order[:, :k - 1], axis=1)
+
+
+def _haversine_radians(lat_1, lng_1, lat_2, lng_2):
+    # same formula as the haversine metric of sklearn, on coordinates in radians
+    a = np.sin((lat_2 - lat_1) / 2) ** 2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((lng_2 - lng_1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class HaversineDistances():
+    """
+    Read-only, array-like view of the great circle distance matrix of points
+    given as [lat, lng] in radians, computed on access and scaled by `scale`
+    (the sphere radius, by default). Supports the same indexing as
+    `LinearDistances`.
+    """
+    def __init__(self, radians, scale=1.0):
+        self.radians = radians
+        self.scale = scale
+        self.shape = (len(radians), len(radians))
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            a = self.radians[rows][:, np.newaxis, :]
+            b = self.radians[cols][np.newaxis, :, :]
         else:
-            ranks = self.get_ranking_from_node_id(reference_node)
+            a = self.radians[rows]
+            b = self.radians[cols]
+
+        return _haversine_radians(a[..., 0], a[..., 1], b[..., 0], b[..., 1]) * self.scale
+
+    def __truediv__(self, divisor):
+        return HaversineDistances(self.radians, self.scale / divisor)
 
-        # get the rank of the node_to_be_ranked
-        node_to_be_ranked_matrix_id = self.node_id_to_matrix_index[node_to_be_ranked]
-        node_rank = ranks[node_to_be_ranked_matrix_id]
+    def max(self):
+        N = self.shape[0]
+        block_size = max(1, STRESS_BLOCK_ELEMENTS // max(N, 1))
 
-        return node_rank
+        return max([ np.max(self[i0:i0 + block_size, 0:N]) for i0 in range(0, N, block_size) ], default=0.0)
+
+
+class HaversineDistanceMatrix():
+    """
+    Counterpart of `DistanceMatrix` for geographic points, using great circle
+    distances. Neighbors and ranks are queried from a `BallTree` with the
+    haversine metric, so the dense distance matrix is never computed.
+
+    @param points   numpy.ndarray of shape (N, 2) with [lat, lng] in degrees.
+                    Node ids are the row indices.
+    @param radius   Radius of the sphere, the unit of `distance_matrix`.
+    """
+    # relative tolerance for distances to count as tied when ranking
+    RANK_TOLERANCE = 1e-10
+
+    def __init__(self, points, radius=6371000):
+        self.radians = np.radians(np.asarray(points, dtype=float))
+        self.n = len(self.radians)
+        self.tree = BallTree(self.radians, metric='haversine')
+        self.distance_matrix = HaversineDistances(self.radians, radius)
+
+    def get_ranks_by_matrix_index(self, reference_indices, ranked_indices):
+        """
+        Same as `DistanceMatrix.get_ranks_by_matrix_index`: the rank of node
+        `ranked_indices[i]` relative to `reference_indices[i]`, where ties get
+        the average rank. The ranks are counts of the nodes within a radius of
+        the reference node.
+        """
+        references = self.radians[np.asarray(reference_indices).ravel()]
+        ranked = self.radians[np.asarray(ranked_indices).ravel()]
+        if references.size == 0:
+            return np.empty(0)
+
+        d = _haversine_radians(references[:, 0], references[:, 1], ranked[:, 0], ranked[:, 1])
+
+        smaller = self.tree.query_radius(references, d * (1 - self.RANK_TOLERANCE), count_only=True)
+        smaller[d == 0] = 0
+        not_larger = self.tree.query_radius(references, d * (1 + self.RANK_TOLERANCE), count_only=True)
+
+        return smaller + (not_larger - smaller + 1) / 2
+
+    def get_kneighbor_candidates(self, k):
+        """
+        Same as `get_kneighbor_candidates` with great circle distances.
+        """
+        return _kneighbor_candidates(lambda n: self.tree.query(self.radians, k=n), self.n, k)
+
+    def get_knn_indices(self, k):
+        """
+        Same as `get_knn_indices` with great circle distances: the `k-1`
+        nearest neighbors of each node, excluding the node itself, in the
+        canonical order.
+        """
+        return get_canonical_kneighbors(*self.get_kneighbor_candidates(k), k)[:, 1:k]
 
 
 def get_neighbour_list(G, node):
@@ -373,19 +742,218 @@ def points_ordering_to_wildfire_structure(points, ordering):
 
 
 def calculate_M1_M2_score(data_org, data_proj, d_org, d_proj, k_vec):
+    df_org = transform_data_to_dataframe(data_org)
+    df_proj = transform_data_to_dataframe(data_proj).loc[df_org.index]
+
+    index_org = d_org.node_id_to_matrix_index[df_org.index].values
+    index_proj = d_proj.node_id_to_matrix_index[df_org.index].values
+
+    return _calculate_M1_M2_from_points(df_org[['x', 'y']].values, df_proj[['x', 'y']].values, k_vec,
+                                        d_org, d_proj, index_org, index_proj)
+
+
+def get_sorted_knn_indices(points, k):
+    """
+    Calculate the k nearest neighbors of every point, including the point
+    itself, in a canonical order: by distance, then by index, with the point
+    itself first. The result has shape (N, k).
+
+    Because of the canonical order, the first k' < k columns are the k'
+    nearest neighbors, so one query at the largest k serves all smaller ones.
+    """
+    return get_canonical_kneighbors(*get_kneighbor_candidates(points, k), k)
+
+
+def get_kneighbor_candidates(points, k):
+    """
+    Distances and indices of a superset of the k nearest neighbors of every
+    point, which contains all points tied at the k-th distance. The canonical
+    k nearest neighbors follow from `get_canonical_kneighbors`, also under a
+    different numbering of the points.
+    """
+    nbrs = NearestNeighbors().fit(points)
+
+    return _kneighbor_candidates(lambda n: nbrs.kneighbors(points, n_neighbors=n), len(points), k)
+
+
+def _kneighbor_candidates(kneighbors, N, k):
+    # query beyond k until no row has a tie at its k-th distance, so that the
+    # choice among equidistant neighbors does not depend on the search tree
+    n_neighbors = min(k + 1, N)
+    while True:
+        distances, indices = kneighbors(n_neighbors)
+        if n_neighbors == N or np.all(distances[:, -1] > distances[:, k - 1]):
+            break
+        n_neighbors = min(2 * n_neighbors, N)
+
+    return distances, indices
+
+
+def get_canonical_kneighbors(distances, indices, k, labels=None):
+    """
+    The first `k` candidates of each row, sorted by distance, then by index,
+    with the point itself first.
+
+    With `labels`, point `i` is numbered `labels[i]` instead: the neighbors
+    are returned as labels and ties are broken by label, as if the candidates
+    had been computed for the renumbered points. The rows stay in the order
+    of `distances`.
+    """
+    rows = np.arange(len(indices))
+    if labels is not None:
+        indices = labels[indices]
+        rows = labels
+
+    not_self = indices != rows[:, np.newaxis]
+    order = np.lexsort((indices, not_self, distances), axis=-1)
+
+    return np.take_along_axis(indices, order[:, :k], axis=1)
+
+
+def get_knn_indices(points, k):
+    """
+    Calculate the k nearest neighbors of every point.
+
+    The first neighbor returned for each point (the point itself) is dropped,
+    just as in `get_graph_from_fire_data`, so the result has shape (N, k-1).
+    """
+    return get_sorted_knn_indices(points, k)[:, 1:k]
+
+
+def get_knn_adjacency(indices):
+    """
+    Turn a kNN index matrix into the boolean adjacency matrix (scipy.sparse,
+    CSR) of the undirected neighborhood graph, i.e., `j` is a neighbor of `i`
+    if either is among the nearest neighbors of the other.
+    """
+    n, k = indices.shape
+    rows = np.repeat(np.arange(n), k)
+    adjacency = sp.csr_matrix((np.ones(rows.size, dtype=bool), (rows, indices.ravel())), shape=(n, n))
+
+    return adjacency + adjacency.T
+
+
+def _neighborhood_difference(adjacency_a, adjacency_b):
+    """
+    Return the (row, column) index pairs of all neighbors in `adjacency_a` that
+    are not neighbors in `adjacency_b`. This is `get_Uk`/`get_Vk` for all nodes
+    at once.
+    """
+    difference = (adjacency_a.astype(np.int8) - adjacency_b.astype(np.int8)).tocoo()
+    mask = difference.data > 0
+
+    return difference.row[mask], difference.col[mask]
+
+
+def get_M_norm_factor(N, k):
+    """
+    Normalization factor of the rank sums in M1 and M2.
+    """
+    N = np.longlong(N)
+    k = np.longlong(k)
+
+    return 2 / (N * k * (2 * N - 3 * k - 1))
+
+
+def _rank_score(rows, cols, d, index, N, k):
+    rank_sum = np.sum(d.get_ranks_by_matrix_index(index[rows], index[cols]) - np.longlong(k))
+
+    return 1 - (get_M_norm_factor(N, k) * rank_sum)
+
+
+def calculate_M1_M2(points, ordering, k_vec, d_org=None, d_proj=None, index_org=None, knn_org=None):
+    """
+    Calculate M1 (trustworthiness) and M2 (continuity) of a 1D projection for
+    every `k` in `k_vec`.
+
+    This gives the same results as `calculate_M1_M2_score`, but works directly
+    on arrays: the kNN index matrices are calculated once, at the largest `k`,
+    and sliced for the smaller ones. The neighborhood differences and rank
+    sums are computed for all nodes at once, without building networkx graphs.
+
+    If `ordering` is a permutation of `0..N-1`, the projected side is handled
+    by a `LinearDistanceMatrix`, unless `d_proj` is given.
+
+    @param points       numpy.ndarray of shape (N, 2) with the coordinates in
+                        the original space.
+    @param ordering     Array of shape (N,), the position of each point in the
+                        projection.
+    @param k_vec        Iterable of neighborhood sizes.
+    @param d_org        Optional `DistanceMatrix` of `points`, used for ranks.
+                        With a `HaversineDistanceMatrix`, neighbors in the
+                        original space are geodesic as well.
+    @param d_proj       Optional `DistanceMatrix` or `LinearDistanceMatrix` of
+                        the projected points.
+    @param index_org    Optional array of shape (N,), the row of `d_org` of
+                        each point, if `d_org` is numbered differently.
+    @param knn_org      Optional precomputed `max(k_vec) - 1` nearest
+                        neighbors of each point in the original space, as in
+                        `get_knn_indices_for_sweep`.
+    """
+    points = np.asarray(points)
+    points_proj = np.column_stack((np.ravel(ordering), np.zeros(len(points))))
+
+    if d_org is None:
+        d_org = DistanceMatrix.from_array(points)
+    if d_proj is None:
+        if LinearDistanceMatrix.is_applicable(ordering):
+            d_proj = LinearDistanceMatrix(ordering)
+        else:
+            d_proj = DistanceMatrix.from_array(points_proj)
+
+    return _calculate_M1_M2_from_points(points, points_proj, k_vec, d_org, d_proj, index_org=index_org,
+                                        knn_org=knn_org)
+
+
+def get_knn_indices_for_sweep(points_org, points_proj, d_org, d_proj, k_max, knn_org=None):
+    """
+    The `k_max - 1` nearest neighbors of every node in the original space and
+    in the projection, sorted canonically, so that the first `k - 1` columns
+    are the neighborhoods for any `k <= k_max`. Precomputed neighbors in the
+    original space can be passed as `knn_org`.
+    """
+    if knn_org is None and isinstance(d_org, HaversineDistanceMatrix):
+        knn_org = d_org.get_knn_indices(k_max)
+    elif knn_org is None:
+        knn_org = get_knn_indices(points_org, k_max)
+    if isinstance(d_proj, LinearDistanceMatrix):
+        knn_proj = d_proj.get_knn_indices(k_max)
+    else:
+        knn_proj = get_knn_indices(points_proj, k_max)
+
+    return knn_org, knn_proj
+
+
+def _calculate_M1_M2_from_points(points_org, points_proj, k_vec, d_org, d_proj, index_org=None, index_proj=None,
+        knn_org=None):
+    N = len(points_org)
+    assert N == len(points_proj)
+
+    if index_org is None:
+        index_org = np.arange(N)
+    if index_proj is None:
+        index_proj = np.arange(N)
+
     M1 = []
     M2 = []
 
+    # one query at the largest k, smaller neighborhoods are prefixes of it
+    knn_org, knn_proj = get_knn_indices_for_sweep(points_org, points_proj, d_org, d_proj, max(k_vec), knn_org)
+
     for k in k_vec:
-        G_org = get_graph_from_fire_data(data_org, k, distance_metric='euclidean')
-        G_proj = get_graph_from_fire_data(data_proj, k, distance_metric='euclidean')
-        M1.append(calculate_M1(G_org, G_proj, d_org, k))
-        M2.append(calculate_M2(G_org, G_proj, d_proj, k))
+        adjacency_org = get_knn_adjacency(knn_org[:, :k - 1])
+        adjacency_proj = get_knn_adjacency(knn_proj[:, :k - 1])
+
+        # Uk: neighbors in the projection, but not in the original space
+        M1.append(_rank_score(*_neighborhood_difference(adjacency_proj, adjacency_org), d_org, index_org, N, k))
+        # Vk: neighbors in the original space, but not in the projection
+        M2.append(_rank_score(*_neighborhood_difference(adjacency_org, adjacency_proj), d_proj, index_proj, N, k))
 
     return M1, M2
 
 
-def calculate_metric_stress(dissimilarities_original, dissimilarities_projection, norm=True):
+def calculate_metric_stress(dissimilarities_original, dissimilarities_projection, norm=True, block_size=None,
+                            scale_original=1.0, scale_projection=1.0):
     """
     Calculate metric stress
 
@@ -393,6 +961,13 @@ def calculate_metric_stress(dissimilarities_original, dissimilarities_projection
     change normalization reference.
     The closer it is to zero, the lower the stress and the better the fit
 
+    The sums run over the lower triangle of the matrices and are computed in
+    blocks of `block_size` rows, so that the temporary arrays stay small for
+    large N. By default, a block has about `STRESS_BLOCK_ELEMENTS` entries.
+    The dissimilarities are divided by `scale_original` and
+    `scale_projection` block by block, so that a (memory-mapped) matrix is
+    not copied to normalize it.
+
     Galbraith, J. I., et al. The analysis and interpretation of multivariate data for social scientists. Crc Press, 2002.
     Download link for relevant chapter: http://www.bristol.ac.uk/media-library/sites/cmm/migrated/documents/chapter3.pdf
     """
@@ -402,12 +977,21 @@ def calculate_metric_stress(dissimilarities_original, dissimilarities_projection
     if N <= 1:
         return 0
 
+    if block_size is None:
+        block_size = max(1, STRESS_BLOCK_ELEMENTS // N)
+
     numerator = 0
     denominator = 0
-    for i in range(N):
-        for j in range(i):
-            numerator = numerator + (dissimilarities_projection[i, j] - dissimilarities_original[i, j]) ** 2
-            denominator = denominator + (dissimilarities_projection[i, j]) ** 2
+    for i0 in range(0, N, block_size):
+        i1 = min(i0 + block_size, N)
+
+        # row i0 + r of the block only contributes its entries j < i0 + r
+        projection = np.tril(dissimilarities_projection[i0:i1, :i1] / scale_projection, k=i0 - 1)
+        original = np.tril(dissimilarities_original[i0:i1, :i1] / scale_original, k=i0 - 1)
+
+        numerator = numerator + np.sum((projection - original) ** 2)
+        denominator = denominator + np.sum(projection ** 2)
+
     if norm:
         return sqrt(numerator / denominator)
 
@@ -415,10 +999,51 @@ def calculate_metric_stress(dissimilarities_original, dissimilarities_projection
         return numerator
 
 
-def calculate_nonmetric_stress(dissimilarities_original, dissimilarities_projection):
+def get_upper_triangle(dissimilarities):
+    """
+    Return the entries above the diagonal of a distance matrix (numpy.ndarray,
+    `CondensedDistances` or `LinearDistances`) as a vector, in the order of
+    `numpy.triu_indices`.
+
+    The entries are copied in blocks of rows, so that no index arrays of the
+    size of the whole triangle are needed.
+    """
+    if isinstance(dissimilarities, CondensedDistances):
+        return dissimilarities.upper_triangle()
+
+    N = dissimilarities.shape[0]
+    upper = np.empty(N * (N - 1) // 2)
+    block_size = max(1, STRESS_BLOCK_ELEMENTS // max(N, 1))
+
+    for i0 in range(0, N, block_size):
+        i1 = min(i0 + block_size, N)
+        block = np.asarray(dissimilarities[i0:i1, i0:N])
+
+        rows, cols = np.triu_indices(i1 - i0, k=1, m=N - i0)
+        upper[_condensed_offset(i0, N):_condensed_offset(i1, N)] = block[rows, cols]
+
+    return upper
+
+
+def sample_pairs(N, n_pairs, rng):
+    """
+    Draw `n_pairs` node pairs `i != j` uniformly, with replacement.
+    """
+    i = rng.randint(0, N, size=n_pairs)
+    j = rng.randint(0, N - 1, size=n_pairs)
+    j[j >= i] += 1
+
+    return i, j
+
+
+def calculate_nonmetric_stress(dissimilarities_original, dissimilarities_projection, max_pairs=None, seed=0):
     """
     :param dissimilarities_original: pairwise distance matrix of data in original space
     :param dissimilarities_projection: pairwise distance matrix of data in projected space
+    :param max_pairs: if the matrices have more than this many pairs, the stress
+        is approximated from a uniform sample of `max_pairs` pairs. `None` always
+        uses all pairs.
+    :param seed: seed for the sample of pairs
     :return:
 
     Goodhill, Geoffrey J., and Terrence J. Sejnowski.
@@ -432,21 +1057,51 @@ def calculate_nonmetric_stress(dissimilarities_original, dissimilarities_project
      # no stress if original and projection "equal" (only one sample)
     if N_org <= 1:
         return 0
-    # D_ref_vec = return_upper_tril_vector(D_ref)
-    # D_other_vec = return_upper_tril_vector(D_other)
+
+    if max_pairs is not None and N_org * (N_org - 1) // 2 > max_pairs:
+        i, j = sample_pairs(N_org, max_pairs, np.random.RandomState(seed))
+
+        diss_org_vec = np.asarray(dissimilarities_original[i, j], dtype=np.float64).ravel()
+        diss_proj_vec = np.asarray(dissimilarities_projection[i, j], dtype=np.float64).ravel()
+
+        return calculate_nonmetric_stress_from_vectors(diss_org_vec, diss_proj_vec)
 
     # create vector of entries based on upper triangle matrix (distance matrix is symmetric, omit diagonal part)
-    diss_org_vec = dissimilarities_original[np.triu_indices(N_org, k=1)].ravel()
-    diss_proj_vec = dissimilarities_projection[np.triu_indices(N_org, k=1)].ravel()
+    diss_org_vec = get_upper_triangle(dissimilarities_original)
+    diss_proj_vec = get_upper_triangle(dissimilarities_projection)
+
+    return calculate_nonmetric_stress_from_vectors(diss_org_vec, diss_proj_vec)
+
+
+def calculate_nonmetric_stress_from_vectors(diss_org_vec, diss_proj_vec):
+    """
+    Nonmetric stress of paired dissimilarities, i.e., `calculate_nonmetric_stress`
+    on the upper triangles of both matrices. Also used on samples of pairs.
+
+    The pairs are sorted once by original dissimilarity. Pairs with the same
+    original dissimilarity are pooled to their mean, as `IsotonicRegression`
+    does, and the pooled values are fitted by the compiled pool-adjacent-
+    violators pass of `sklearn.isotonic.isotonic_regression`.
+    """
+    # the order within ties does not matter, they are pooled below
+    order = np.argsort(diss_org_vec)
+    diss_org_sorted = diss_org_vec[order]
+    diss_proj_sorted = np.asarray(diss_proj_vec, dtype=np.float64)[order]
+    del order
 
+    # ties, with the same tolerance as IsotonicRegression
+    eps = np.finfo(diss_org_sorted.dtype).resolution
+    starts = np.flatnonzero(np.concatenate(([True], np.diff(diss_org_sorted) >= eps)))
+    del diss_org_sorted
 
-    iso = IsotonicRegression(increasing=True).fit(diss_org_vec, diss_proj_vec)
-    disparities = iso.predict(diss_org_vec)
+    counts = np.diff(np.append(starts, diss_proj_sorted.size)).astype(np.float64)
+    means = np.add.reduceat(diss_proj_sorted, starts) / counts
 
-    # plot_for_to_visualize_non_metric_stress_calculation(diss_org_vec, diss_proj_vec, disparities, iso)
+    fitted = isotonic_regression(means, sample_weight=counts, increasing=True)
+    disparities = np.repeat(fitted, counts.astype(np.int64))
 
-    numerator = np.sum((diss_proj_vec - disparities) ** 2)
-    denominator = np.sum(diss_proj_vec ** 2)
+    numerator = np.sum((diss_proj_sorted - disparities) ** 2)
+    denominator = np.sum(diss_proj_sorted ** 2)
 
     return np.sqrt(numerator/denominator)
 
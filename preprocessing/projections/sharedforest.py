@@ -0,0 +1,206 @@
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from datatypes import Datum
+
+
+# alignment of the arrays in the shared memory block, in bytes
+_ALIGNMENT = 64
+
+
+class SharedForest:
+    '''
+    Columnar copy of a <datum>[] forest in one block of shared memory, which
+    worker processes attach to instead of receiving the <datum> objects.
+
+    Only what the projections need is copied: coordinates, time series and
+    the hierarchy. The ids are kept as they are in `ids` (they need not be
+    strings) and are pickled with the `handle`, once per worker. Everything
+    else (e.g., GeoJSON geometries) stays in the process that created the
+    forest, unless it is created with `attributes`. The data and the subtrees (the root
+    level and each datum with children) are numbered level by level, the
+    subtrees in the order of `iter_subtrees`, so subtree 0 is the root level.
+
+    Arrays, in `arrays`:
+
+    * `lat`, `lng`, `x`, `y` and `parent` (-1 on the root level), one entry
+      per datum.
+    * `subtree_datum` (-1 for the root level) and `subtree_offset`: the
+      children of subtree `s` are `children[subtree_offset[s]:subtree_offset[s+1]]`.
+    * `timeseries<i>`: one row per datum with `tsfunc(datum)` for the i-th
+      `(tsfunc, tslen)`.
+
+    Create it with `SharedForest.create` and release it with `close` (or use
+    it as a context manager). Workers attach with `SharedForest.attach(*handle)`.
+    '''
+    def __init__(self, shm, layout, ids, attributes=None, owner=False):
+        self._shm = shm
+        self.layout = layout
+        self.ids = ids
+        self.attributes = attributes
+        self.owner = owner
+
+        self.arrays = dict()
+        for name, (dtype, shape, offset) in layout.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            if not owner:
+                array.flags.writeable = False
+            self.arrays[name] = array
+
+
+    @classmethod
+    def create(cls, data, coordinates, timeseries=(), attributes=False):
+        '''
+        Copy a forest into a new block of shared memory.
+
+        @param data         <datum>[] forest.
+
+        @param coordinates  `ProjectedCoordinates` of the forest.
+
+        @param timeseries   List of `(tsfunc, tslen)`, see `SubtreeContext.timeseries`.
+
+        @param attributes   If True, the other attributes of each datum
+                            (`name`, `data`, ...), except for `children`, are
+                            kept in `attributes` and passed on with the
+                            `handle`, for projections that read them.
+        '''
+        forest, parent = [], []
+        subtree_datum, subtree_children = [], []
+
+        # level by level, with the subtrees in the order in which they are entered
+        queue = deque([ (data, -1) ])
+        while len(queue) > 0:
+            children, p = queue.popleft()
+            subtree_datum.append(p)
+            subtree_children.append([])
+
+            for datum in children:
+                i = len(forest)
+                forest.append(datum)
+                parent.append(p)
+                subtree_children[-1].append(i)
+
+                if datum.children is not None and len(datum.children) > 0:
+                    queue.append((datum.children, i))
+
+        indices = np.fromiter((coordinates.index[d.id] for d in forest), dtype=np.int64, count=len(forest))
+
+        arrays = dict(
+            lat=np.array([ np.nan if d.lat is None else d.lat for d in forest ], dtype=float),
+            lng=np.array([ np.nan if d.lng is None else d.lng for d in forest ], dtype=float),
+            x=coordinates.x[indices],
+            y=coordinates.y[indices],
+            parent=np.array(parent, dtype=np.int64),
+            subtree_datum=np.array(subtree_datum, dtype=np.int64),
+            subtree_offset=np.cumsum([ 0 ] + [ len(c) for c in subtree_children ], dtype=np.int64),
+            children=np.array([ i for c in subtree_children for i in c ], dtype=np.int64),
+        )
+        for t, (tsfunc, tslen) in enumerate(timeseries):
+            samples = np.ndarray(shape=(len(forest), tslen), dtype=float)
+            for i, d in enumerate(forest):
+                samples[i] = tsfunc(d)
+            arrays[F'timeseries{t}'] = samples
+
+        layout, size = dict(), 0
+        for name, array in arrays.items():
+            size = -(-size // _ALIGNMENT) * _ALIGNMENT
+            layout[name] = (array.dtype.str, array.shape, size)
+            size += array.nbytes
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        details = None
+        if attributes:
+            details = [ { k: v for k, v in vars(d).items() if k not in ('id', 'lat', 'lng', 'children') }
+                        for d in forest ]
+
+        shared = cls(shm, layout, [ d.id for d in forest ], details, owner=True)
+        for name, array in arrays.items():
+            shared.arrays[name][...] = array
+
+        return shared
+
+
+    @classmethod
+    def attach(cls, name, layout, ids, attributes=None):
+        '''
+        Attach (read-only) to a forest created in another process, from its `handle`.
+        '''
+        return cls(shared_memory.SharedMemory(name=name), layout, ids, attributes)
+
+
+    @property
+    def handle(self):
+        '''
+        `(name, layout, ids, attributes)`, all that `attach` needs. Apart
+        from the ids and attributes, it is small to pickle.
+        '''
+        return self._shm.name, self.layout, self.ids, self.attributes
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    @property
+    def n_subtrees(self):
+        return len(self.arrays['subtree_datum'])
+
+
+    def subtree_indices(self, s):
+        '''
+        The indices of the children of subtree `s`.
+        '''
+        offset = self.arrays['subtree_offset']
+        return self.arrays['children'][offset[s]:offset[s+1]]
+
+
+    def subtree_id(self, s):
+        i = self.arrays['subtree_datum'][s]
+        return '@@ROOT@@' if i < 0 else self.ids[i]
+
+
+    def subtree_data(self, s):
+        '''
+        <datum>[] of the children of subtree `s`, with `id`, `lat` and `lng`,
+        and the other attributes if the forest was created with `attributes`.
+        Otherwise, `name` is set to the id and `data` is None. `children` are
+        never available.
+        '''
+        ids, lat, lng = self.ids, self.arrays['lat'], self.arrays['lng']
+        if self.attributes is None:
+            return [ Datum(ids[i], ids[i], float(lat[i]), float(lng[i]), None)
+                     for i in self.subtree_indices(s) ]
+        return [ Datum(ids[i], lat=float(lat[i]), lng=float(lng[i]), **self.attributes[i])
+                 for i in self.subtree_indices(s) ]
+
+
+    def timeseries(self, t, s):
+        '''
+        numpy.ndarray with the i-th `(tsfunc, tslen)` of the children of subtree `s`.
+        '''
+        return self.arrays[F'timeseries{t}'][self.subtree_indices(s)]
+
+
+    def close(self):
+        '''
+        Release the shared memory, and free it if this is the process that
+        created it. Arrays from `arrays` must not be used afterwards.
+        '''
+        if self._shm is None:
+            return
+
+        self.arrays = dict()
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+        self._shm = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
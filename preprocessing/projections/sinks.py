@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+from collections import defaultdict
+from operator import itemgetter
+
+from datatypes.projection import Projection as ProjectionData
+from datatypes.projection import SubtreeLevelOrder, PerLevelOrders
+from projections.ordercache import _to_json
+
+
+class LevelOrderSink:
+    '''
+    Receives the `SubtreeLevelOrder` of each subtree of a projection as soon
+    as it is finished, in any order, and creates the <projection> objects
+    from them. This one keeps them in memory until then.
+    '''
+    def __init__(self):
+        self._records = defaultdict(list)
+
+
+    def add(self, key, index, depth, parent_id, order):
+        '''
+        @param key          Key of the projection.
+
+        @param index        Position of the subtree in the order of
+                            `iter_subtrees`, which is kept in the output.
+
+        @param depth        Level of the subtree, 0 for the root level.
+
+        @param parent_id    Id of the parent, `@@ROOT@@` for the root level.
+
+        @param order        `SubtreeLevelOrder` of the subtree.
+        '''
+        self._records[key].append((index, depth, parent_id, order))
+
+
+    def projection(self, key, name=None, description=None):
+        '''
+        The <projection> object of all records of `key`, which are released.
+        '''
+        records = sorted(self._records.pop(key), key=itemgetter(0))
+        return create_projection_data(key, name, description, ( record[1:] for record in records ))
+
+
+class SpillSink(LevelOrderSink):
+    '''
+    Writes the records of each projection to a temporary file as they come,
+    so that they are not all kept in memory. `projection` returns a
+    `SpilledProjection`, which only reads them back while it is serialized.
+
+    @param directory    Directory for the temporary files, defaults to the
+                        system's temporary directory.
+    '''
+    def __init__(self, directory=None):
+        self._directory = tempfile.TemporaryDirectory(dir=directory)
+        self._files = dict()
+
+
+    def add(self, key, index, depth, parent_id, order):
+        if key not in self._files:
+            self._files[key] = open(os.path.join(self._directory.name, F'{len(self._files)}.jsonl'), 'w')
+
+        self._files[key].write(json.dumps([ index, depth, parent_id, order.__dict__ ], default=_to_json))
+        self._files[key].write('\n')
+
+
+    def projection(self, key, name=None, description=None):
+        f = self._files.pop(key)
+        f.close()
+        return SpilledProjection(self, f.name, key, name, description)
+
+
+class SpilledProjection:
+    '''
+    A <projection> whose level orders stay in a file of a `SpillSink` until
+    it is serialized (see `Dataset.to_json`) or `load`ed.
+    '''
+    def __init__(self, sink, path, key, name, description):
+        # the sink owns the temporary directory
+        self._sink = sink
+        self.path = path
+        self.key = key
+        self.name = name
+        self.description = description
+
+
+    def load(self):
+        '''
+        The <projection> object, read from the file.
+        '''
+        with open(self.path) as f:
+            records = sorted(( json.loads(line) for line in f ), key=itemgetter(0))
+
+        return create_projection_data(self.key, self.name, self.description,
+                ( (depth, parent_id, SubtreeLevelOrder.from_json(order)) for _, depth, parent_id, order in records ))
+
+
+    def to_json_dict(self):
+        return self.load().__dict__
+
+
+def create_projection_data(key, name, description, records):
+    '''
+    Create the <projection> object from `(depth, parent id, SubtreeLevelOrder)`
+    records, in the order of `iter_subtrees`.
+    '''
+    per_level = []
+    for depth, parent_id, order in records:
+        while len(per_level) <= depth:
+            per_level.append(dict())
+        per_level[depth][parent_id] = order
+
+    root_order = per_level[0]['@@ROOT@@'].order
+    per_level = [ PerLevelOrders(**level) for level in per_level ]
+
+    # create total ordering: pre-order, without recursion
+    total_order = []
+    stack = [ (iter(root_order), 1) ]
+    while len(stack) > 0:
+        items, depth = stack[-1]
+        item = next(items, _END)
+        if item is _END:
+            stack.pop()
+            continue
+
+        total_order.append(item)
+        if depth < len(per_level) and item in per_level[depth].__dict__:
+            stack.append((iter(per_level[depth].__dict__[item].order), depth+1))
+
+    return ProjectionData(key=key, name=name, description=description, total_order=total_order, per_level=per_level)
+
+
+_END = object()
+
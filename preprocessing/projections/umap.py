@@ -1,35 +1,43 @@
-from projections.projection import GeospatialProjection
-from util.quadtree import Point
+from projections.projection import ArrayProjection
 
+import numpy as np
 from umap import UMAP
 
 
-class UMAPProjection(GeospatialProjection):
-    def add_data(self, data, n_neighbors=10, metric='euclidean', **kwargs):
+class UMAPProjection(ArrayProjection):
+    # far below n_neighbors, where setting up UMAP costs the most and gives the least
+    trivial_size = 3
+
+    def add_data(self, xy, ids=None, timeseries=None, context=None, n_neighbors=10, metric='euclidean', **kwargs):
         self.kwargs = kwargs
 
-        if len(data) == 1:
-            self.data = [ Point(self.x_fn(data[0]), self.y_fn(data[0]), data[0]) ]
+        if len(xy) == 1:
+            self.permutation = np.zeros(1, dtype=np.int64)
             return
 
-        self.data = list()
+        fit = UMAP(n_neighbors=n_neighbors, n_components=1, metric=metric)
+        u = fit.fit_transform(xy)
+        self.permutation = np.argsort(u[:, 0], kind='stable')
 
-        pointdata = [[self.x_fn(d), self.y_fn(d)] for d in data]
 
-        fit = UMAP(n_neighbors=n_neighbors, n_components=1, metric=metric)
-        u = fit.fit_transform(pointdata)
-        orderable = [(i,x[0]) for i, x in enumerate(u)]
-        orderable.sort(key=lambda x: x[1])
-        for i,_ in orderable:
-            self.data.append(Point(self.x_fn(data[i]), self.y_fn(data[i]), data[i]))
+    def add_trivial_data(self, xy, n_neighbors=10, metric='euclidean', **kwargs):
+        self.kwargs = kwargs
+
+        # along the line through the two entities farthest apart, which end up at both ends
+        d = np.sum((xy[:, np.newaxis] - xy[np.newaxis, :]) ** 2, axis=2)
+        i, j = np.unravel_index(np.argmax(d), d.shape)
+        self.permutation = np.argsort((xy - xy[i]) @ (xy[j] - xy[i]), kind='stable')
 
 
-    def _order(self):
-        return self.data
+    def order(self):
+        return self.permutation
 
 
     def metadata(self):
         return dict()
 
 
-
+    @classmethod
+    def estimate_cost(cls, n, n_neighbors=10, **kwargs):
+        # the optimization has a large fixed cost, even for small inputs
+        return 1e7 + 200 * n * n_neighbors
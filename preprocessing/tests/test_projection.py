@@ -0,0 +1,532 @@
+import io
+import sys
+import os
+import tempfile
+
+# include parent dir
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import numpy as np
+from datatypes import Dataset, Datum
+from projections.projection import ArrayProjection, GeospatialProjection, Projection, ProjectedCoordinates, \
+    create_projection
+from projections.pipeline import SubtreeContext, create_projections_by_subtree, _batch_tasks
+from projections.sharedforest import SharedForest
+from projections.ordercache import OrderCache
+from projections.checkpoints import ProjectionCheckpoints
+from projections.sinks import SpillSink
+from projections.hilbert import HilbertProjection, _transitions as hilbert_transitions
+from projections.morton import MortonProjection
+from projections.hierarchicalclustering import HierarchicalClusteringProjection
+from projections.dynamictimewarping import DynamicTimeWarpingProjection
+from projections.firstoccurrence import FirstOccurrenceProjection
+from projections.umap import UMAPProjection
+from util.quadtree import Point
+from util.spacefillingcurves import squarified_bounds, curve_order, morton_order
+from util.timing import Tracer
+
+
+def _forest(seed, n=10, depth=2, prefix=''):
+    data = []
+    for i in range(n):
+        children = _forest(seed, n, depth - 1, F'{prefix}{i}.') if depth > 0 else None
+        data.append(Datum(F'{prefix}{i}', F'{prefix}{i}', seed.uniform(-40, -10), seed.uniform(115, 150),
+                          list(seed.rand(4)), children))
+    return data
+
+
+def _grid_forest(seed, n=12, depth=2, prefix=''):
+    # distinct cells of a regular grid, so that many distances are tied
+    cells = seed.choice(400, n, replace=False)
+    data = []
+    for i, cell in enumerate(cells):
+        children = _grid_forest(seed, n, depth - 1, F'{prefix}{i}.') if depth > 0 else None
+        data.append(Datum(F'{prefix}{i}', F'{prefix}{i}', -40 + (cell // 20) * 0.5, 115 + (cell % 20) * 0.5,
+                          list(seed.rand(4)), children))
+    return data
+
+
+def test_projected_coordinates():
+    seed = np.random.RandomState(seed=0)
+    data = _forest(seed)
+    coordinates = ProjectedCoordinates(data)
+
+    # same as transforming each datum on its own
+    legacy = GeospatialProjection()
+    for subtree in (data, data[3].children, data[3].children[5].children):
+        expected = [ [legacy.x_fn(d), legacy.y_fn(d)] for d in subtree ]
+        assert np.array_equal(coordinates.xy(subtree), expected)
+        assert np.array_equal(GeospatialProjection(coordinates).xy(subtree), expected)
+        assert np.array_equal(legacy.xy(subtree), expected)
+
+
+def test_projected_coordinates_validation():
+    seed = np.random.RandomState(seed=1)
+
+    for lat in (float('nan'), None, float('inf')):
+        data = _forest(seed)
+        data[2].children[4].lat = lat
+
+        try:
+            ProjectedCoordinates(data)
+            assert False
+        except ValueError as e:
+            assert '2.4' in str(e)
+
+    data = _forest(seed)
+    data[1].children[0].id = data[0].id
+    try:
+        ProjectedCoordinates(data)
+        assert False
+    except ValueError:
+        pass
+
+
+class _WestToEastProjection(ArrayProjection):
+    def add_data(self, xy, ids=None, timeseries=None, context=None):
+        self.permutation = np.argsort(xy[:, 0], kind='stable')
+
+
+    def order(self):
+        return self.permutation
+
+
+class _WestToEastPointProjection(GeospatialProjection):
+    def add_data(self, data, context=None):
+        xy = self.xy(data, context)
+        self.data = sorted((Point(x, y, d) for (x, y), d in zip(xy, data)), key=lambda p: p.x)
+
+
+    def _order(self):
+        return self.data
+
+
+    def metadata(self):
+        return dict()
+
+
+class _WestToEastLegacyProjection(Projection):
+    # the original interface: no coordinates, no context
+    def add_data(self, data):
+        self.data = sorted(data, key=lambda d: d.lng)
+
+
+    def _order(self):
+        return [ Point(d.lng, d.lat, d) for d in self.data ]
+
+
+class _WestToEastGridProjection(GeospatialProjection):
+    # with the metadata of GeospatialProjection
+    add_data = _WestToEastPointProjection.add_data
+    _order = _WestToEastPointProjection._order
+
+
+class _TimeSeriesLegacyProjection(Projection):
+    # reads attributes of the <datum> other than id, lat and lng
+    def add_data(self, data):
+        self.data = sorted(data, key=lambda d: (d.data[0], d.name))
+
+
+    def _order(self):
+        return [ Point(d.lng, d.lat, d) for d in self.data ]
+
+
+def test_array_projection():
+    seed = np.random.RandomState(seed=6)
+    data = _forest(seed)
+
+    array_native = create_projection(_WestToEastProjection, data)
+    adapted = create_projection(_WestToEastPointProjection, data)
+
+    assert array_native.total_order == adapted.total_order
+    assert array_native.per_level[0].__dict__['@@ROOT@@'].order == [ d.id for d in sorted(data, key=lambda d: d.lng) ]
+    for level, adapted_level in zip(array_native.per_level, adapted.per_level):
+        for parent, order in level.__dict__.items():
+            assert order.__dict__ == adapted_level.__dict__[parent].__dict__
+
+    # the grid cell of the points, as for the curves
+    grid = create_projection(_WestToEastGridProjection, data)
+    hilbert = create_projection(HilbertProjection, data)
+    for level, hilbert_level in zip(grid.per_level, hilbert.per_level):
+        for parent, order in level.__dict__.items():
+            assert order.grid_cell == hilbert_level.__dict__[parent].grid_cell
+
+
+def test_legacy_projection():
+    seed = np.random.RandomState(seed=8)
+    data = _forest(seed)
+
+    expected = create_projection(_WestToEastProjection, data)
+    legacy = create_projection(_WestToEastLegacyProjection, data)
+    [ by_subtree ] = create_projections_by_subtree(data, [ (_WestToEastLegacyProjection, 'legacy', None, None,
+                                                            dict()) ], processes=1)
+
+    for proj in (legacy, by_subtree):
+        assert proj.total_order == expected.total_order
+        for level, expected_level in zip(proj.per_level, expected.per_level):
+            for parent, order in level.__dict__.items():
+                assert order.__dict__ == expected_level.__dict__[parent].__dict__
+
+    # the workers get the attributes of the <datum> as well
+    expected = create_projection(_TimeSeriesLegacyProjection, data)
+    for processes in (1, 2):
+        [ by_subtree ] = create_projections_by_subtree(data, [ (_TimeSeriesLegacyProjection, 'legacy', None, None,
+                                                                dict()) ], processes=processes)
+        assert by_subtree.total_order == expected.total_order
+
+
+def test_fast_path():
+    seed = np.random.RandomState(seed=9)
+    data = _forest(seed, n=3, depth=0)
+    for i, d in enumerate(data):
+        d.children = _forest(seed, n=i+1, depth=0, prefix=F'{d.id}.')
+    coordinates = ProjectedCoordinates(data)
+
+    projections = [ (HierarchicalClusteringProjection, dict(method='ward')),
+                    (DynamicTimeWarpingProjection, dict(tslen=4, method='single', global_constraint=None)),
+                    (FirstOccurrenceProjection, dict(tslen=4)) ]
+
+    # the same orders as without the fast path
+    for cls, kwargs in projections:
+        proj = create_projection(cls, data, coordinates=coordinates, **kwargs)
+        for d in data:
+            p = cls()
+            p.add_data(coordinates.xy(d.children), timeseries=np.array([ c.data for c in d.children ]),
+                       **{ k: v for k, v in kwargs.items() if k != 'tslen' })
+            assert proj.per_level[1].__dict__[d.id].order == [ d.children[i].id for i in p.order() ]
+
+    # UMAP: the two points farthest apart at the ends
+    proj = create_projection(UMAPProjection, data, coordinates=coordinates)
+    order = [ int(id.split('.')[1]) for id in proj.per_level[1].__dict__['2'].order ]
+    xy = coordinates.xy(data[2].children)
+    d = np.sum((xy[:, np.newaxis] - xy[np.newaxis, :]) ** 2, axis=2)
+    assert d[order[0], order[2]] == d.max()
+    assert proj.per_level[1].__dict__['0'].__dict__ == dict(order=['0.0'], metric_stress=0, nonmetric_stress=0,
+                                                            M1=1, M2=1)
+
+
+def test_global_curve():
+    seed = np.random.RandomState(seed=10)
+    data = _grid_forest(seed, n=6, depth=2)
+    coordinates = ProjectedCoordinates(data)
+    xy = np.column_stack((coordinates.x, coordinates.y))
+
+    for cls, order in ((HilbertProjection, curve_order), (MortonProjection, morton_order)):
+        transitions = (hilbert_transitions, ) if cls is HilbertProjection else ()
+        local = create_projection(cls, data, coordinates=coordinates)
+        proj = create_projection(cls, data, coordinates=coordinates, curve='global')
+
+        # each subtree in the order of the curve through the whole forest
+        rank = np.argsort(order(xy, squarified_bounds(xy), *transitions))
+        for level, local_level in zip(proj.per_level, local.per_level):
+            for parent, subtree in level.__dict__.items():
+                assert subtree.order == sorted(subtree.order, key=lambda id: rank[coordinates.index[id]])
+                assert subtree.grid_cell == local_level.__dict__[parent].grid_cell
+        assert ('curve_ranks', cls) in coordinates._cache
+
+    # the same global ranks in the workers
+    projs = create_projections_by_subtree(data, [ (HilbertProjection, None, None, None, dict(curve='global')) ],
+            coordinates=coordinates, processes=2)
+    assert projs[0].total_order == create_projection(HilbertProjection, data, curve='global').total_order
+
+    with tempfile.TemporaryDirectory() as directory:
+        def _computed(data):
+            tracer = Tracer()
+            create_projection(HilbertProjection, data, tracer=tracer, cache=OrderCache(directory), curve='global')
+            return [ span for span in tracer.report()['spans'] if span['name'] == 'add_data' ]
+
+        assert len(_computed(data)) > 0
+        assert _computed(data) == []
+
+        # the subtrees did not change, but the extent of the forest did
+        data[0].children[0].children[0].lat -= 10
+        assert len(_computed(data)) == 1 + 6 + 36
+
+
+def test_subtree_pipeline():
+    seed = np.random.RandomState(seed=2)
+    data = _grid_forest(seed)
+
+    projections = [ (HilbertProjection, 'Hilbert', None, None, dict()),
+                    (HierarchicalClusteringProjection, 'AHC-single', None, None, dict(method='single')),
+                    (HierarchicalClusteringProjection, 'AHC-ward', None, None, dict(method='ward')),
+                    (DynamicTimeWarpingProjection, 'DTW', None, None,
+                        dict(tslen=4, tsfunc=lambda d: d.data, method='single', global_constraint=None)),
+                    (FirstOccurrenceProjection, 'FO', None, None, dict(tslen=4)) ]
+
+    projs = create_projections_by_subtree(data, projections, processes=1)
+
+    # same orders as projection-major, quality up to rounding
+    for (cls, key, name, description, kwargs), proj in zip(projections, projs):
+        expected = create_projection(cls, data, key=key, **kwargs)
+        assert proj.key == key
+        assert proj.total_order == expected.total_order
+
+        for level, expected_level in zip(proj.per_level, expected.per_level):
+            assert list(level.__dict__) == list(expected_level.__dict__)
+            for parent, order in level.__dict__.items():
+                expected_order = expected_level.__dict__[parent].__dict__
+                assert order.order == expected_order['order']
+                for metric in ('M1', 'M2', 'metric_stress', 'nonmetric_stress'):
+                    assert np.isclose(order.__dict__[metric], expected_order[metric], rtol=1e-12, atol=1e-15)
+
+
+def test_subtree_pipeline_ids():
+    seed = np.random.RandomState(seed=10)
+    data = _forest(seed, n=4)
+    # leaf ids need not be strings, e.g., the AdmUnitId of the RKI counties
+    for i, d in enumerate(data):
+        for j, child in enumerate(d.children):
+            for k, leaf in enumerate(child.children):
+                leaf.id = 100 * (4 * i + j) + k if k % 2 == 0 else leaf.id
+
+    projections = [ (HilbertProjection, 'Hilbert', None, None, dict()),
+                    (HierarchicalClusteringProjection, 'AHC', None, None, dict(method='ward')) ]
+    for processes in (1, 2):
+        for (cls, key, _, _, kwargs), proj in zip(projections,
+                create_projections_by_subtree(data, projections, processes=processes)):
+            expected = create_projection(cls, data, key=key, **kwargs)
+            assert proj.total_order == expected.total_order
+            assert 100 in proj.total_order and '0.1.1' in proj.total_order
+            for level, expected_level in zip(proj.per_level, expected.per_level):
+                assert list(level.__dict__) == list(expected_level.__dict__)
+                for parent, order in level.__dict__.items():
+                    assert order.order == expected_level.__dict__[parent].order
+
+
+def test_subtree_pipeline_scheduling():
+    seed = np.random.RandomState(seed=4)
+    data = _grid_forest(seed, n=8)
+
+    projections = [ (MortonProjection, 'Morton', None, None, dict()),
+                    (DynamicTimeWarpingProjection, 'DTW', None, None,
+                        dict(tslen=4, tsfunc=lambda d: d.data, method='single', global_constraint=None)) ]
+
+    # DTW is the expensive one, and larger subtrees cost more
+    assert DynamicTimeWarpingProjection.estimate_cost(100, tslen=4) > MortonProjection.estimate_cost(100)
+    assert MortonProjection.estimate_cost(1000) > MortonProjection.estimate_cost(100)
+
+    # the projections of a subtree together, unless the subtree is more than the share of a worker
+    tasks = [ (s, j) for s in range(3) for j in range(2) ]
+    costs = [ 1, 2, 10, 20, 4, 3 ]
+    assert _batch_tasks(tasks, costs, 1) == [ (1, [ 0, 1 ]), (2, [ 0, 1 ]), (0, [ 0, 1 ]) ]
+    assert _batch_tasks(tasks, costs, 2) == [ (1, [ 1 ]), (1, [ 0 ]), (2, [ 0, 1 ]), (0, [ 0, 1 ]) ]
+
+    # the order in which the tasks finish does not matter
+    expected = create_projections_by_subtree(data, projections, processes=1)
+    for proj, expected_proj in zip(create_projections_by_subtree(data, projections, processes=2), expected):
+        assert proj.total_order == expected_proj.total_order
+        for level, expected_level in zip(proj.per_level, expected_proj.per_level):
+            assert { parent: order.__dict__ for parent, order in level.__dict__.items() } == \
+                   { parent: order.__dict__ for parent, order in expected_level.__dict__.items() }
+
+
+def test_pipeline_trace():
+    seed = np.random.RandomState(seed=7)
+    data = _grid_forest(seed, n=5, depth=1)
+    tracer = Tracer()
+
+    create_projections_by_subtree(data, [ (MortonProjection, 'Morton', None, None, dict()) ], processes=1,
+                                  tracer=tracer)
+
+    report = tracer.report()
+    assert report['stages']['task']['count'] == 6
+    for stage in ('add_data', 'order', 'quality'):
+        spans = [ span for span in report['spans'] if span['name'] == stage ]
+        assert sorted(span['args']['subtree'] for span in spans) == sorted([ '@@ROOT@@' ] + [ d.id for d in data ])
+        assert all(span['args']['projection'] == 'Morton' and span['args']['n'] == 5 for span in spans)
+        assert all(span['wall'] >= 0 and span['cpu'] >= 0 for span in spans)
+
+    trace = tracer.chrome_trace()
+    assert [ event['ph'] for event in trace['traceEvents'] ].count('X') == len(report['spans'])
+
+
+def test_order_cache():
+    seed = np.random.RandomState(seed=8)
+    data = _grid_forest(seed, n=5, depth=1)
+    projections = [ (MortonProjection, 'Morton', None, None, dict()),
+                    (DynamicTimeWarpingProjection, 'DTW', None, None,
+                        dict(tslen=4, tsfunc=lambda d: d.data, method='single', global_constraint=None)) ]
+
+    def _run(cache):
+        tracer = Tracer()
+        projs = create_projections_by_subtree(data, projections, processes=1, tracer=tracer, cache=cache)
+        computed = [ (span['args']['projection'], span['args']['subtree'])
+                     for span in tracer.report()['spans'] if span['name'] == 'add_data' ]
+        return projs, computed
+
+    def _orders(proj):
+        return [ { parent: order.__dict__ for parent, order in level.__dict__.items() } for level in proj.per_level ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        expected, computed = _run(OrderCache(directory))
+        assert len(computed) == 12
+
+        # unchanged: everything from the cache, in a new instance as in a new run
+        projs, computed = _run(OrderCache(directory))
+        assert computed == []
+        assert [ _orders(proj) for proj in projs ] == [ _orders(proj) for proj in expected ]
+
+        # only the time series of one subtree changed
+        data[2].children[1].data[0] += 1
+        projs, computed = _run(OrderCache(directory))
+        assert computed == [ ('DTW', '2') ]
+
+
+class _CrashingProjection(_WestToEastProjection):
+    # fails on the last subtree of a forest from _grid_forest(depth=1, n=5), until it is fixed
+    crash = True
+
+    def add_data(self, xy, ids=None, timeseries=None, context=None):
+        if self.crash and ids[0].startswith('4.'):
+            raise RuntimeError('crashed')
+        super().add_data(xy, ids, timeseries, context)
+
+
+def test_checkpoints():
+    seed = np.random.RandomState(seed=9)
+    data = _grid_forest(seed, n=5, depth=1)
+    projections = [ (MortonProjection, 'Morton', None, None, dict()),
+                    (_CrashingProjection, 'crashing', None, None, dict()) ]
+
+    def _run(checkpoints):
+        tracer = Tracer()
+        projs = create_projections_by_subtree(data, projections, processes=1, tracer=tracer, checkpoints=checkpoints)
+        computed = set(span['args']['projection'] for span in tracer.report()['spans'] if span['name'] == 'task')
+        return projs, computed
+
+    with tempfile.TemporaryDirectory() as directory:
+        # the Morton projection is finished before the other one crashes
+        try:
+            _run(ProjectionCheckpoints(directory))
+            assert False
+        except RuntimeError:
+            pass
+        assert len(os.listdir(directory)) == 1
+
+        _CrashingProjection.crash = False
+        try:
+            projs, computed = _run(ProjectionCheckpoints(directory, resume=True))
+            assert computed == { 'crashing' }
+            assert len(os.listdir(directory)) == 2
+
+            expected = create_projections_by_subtree(data, projections[:1], processes=1)
+            assert projs[0].total_order == expected[0].total_order
+            assert projs[0].per_level[1].__dict__['3'].__dict__ == expected[0].per_level[1].__dict__['3'].__dict__
+
+            # a different configuration is computed again
+            projections[0] = (MortonProjection, 'Morton', 'Morton order', None, dict())
+            _, computed = _run(ProjectionCheckpoints(directory))
+            assert computed == { 'Morton' }
+
+            # without resume, everything is computed
+            _, computed = _run(ProjectionCheckpoints(directory, resume=False))
+            assert computed == { 'Morton', 'crashing' }
+        finally:
+            _CrashingProjection.crash = True
+
+
+def test_subtree_context():
+    seed = np.random.RandomState(seed=3)
+    data = _forest(seed, depth=0)
+    context = SubtreeContext(data, ProjectedCoordinates(data))
+
+    assert context.distance_matrix() is context.distance_matrix()
+    assert np.array_equal(context.indices(data[::-1]), np.arange(len(data))[::-1])
+    assert np.array_equal(context.timeseries(lambda d: d.data, 4), [ d.data for d in data ])
+    assert context.max_distance() == np.max(context.distance_matrix().distance_matrix)
+
+
+def test_shared_forest():
+    seed = np.random.RandomState(seed=5)
+    data = _forest(seed, n=4)
+    coordinates = ProjectedCoordinates(data)
+    tsfunc = lambda d: d.data
+
+    with SharedForest.create(data, coordinates, [ (tsfunc, 4) ]) as forest:
+        assert len(forest) == 4 + 16 + 64
+        # subtrees level by level, as in iter_subtrees
+        assert [ forest.subtree_id(s) for s in range(forest.n_subtrees) ][:6] == [ '@@ROOT@@', '0', '1', '2', '3', '0.0' ]
+
+        # workers only get read-only views
+        attached = SharedForest.attach(*forest.handle)
+        assert not attached.arrays['x'].flags.writeable
+        assert attached.subtree_data(1)[0].data is None
+
+        for s, subtree in ((0, data), (2, data[1].children), (5, data[0].children[0].children)):
+            assert [ d.id for d in attached.subtree_data(s) ] == [ d.id for d in subtree ]
+            assert np.array_equal(attached.timeseries(0, s), [ d.data for d in subtree ])
+            assert np.array_equal(coordinates.xy(attached.subtree_data(s)), coordinates.xy(subtree))
+
+        root = forest.arrays['parent'][forest.subtree_indices(5)]
+        assert all(forest.ids[i] == '0.0' for i in root)
+        attached.close()
+
+    with SharedForest.create(data, coordinates, attributes=True) as forest:
+        attached = SharedForest.attach(*forest.handle)
+        [ datum ] = [ d for d in attached.subtree_data(1) if d.id == '0.2' ]
+        assert (datum.name, datum.data, datum.children) == ('0.2', data[0].children[2].data, None)
+        attached.close()
+
+
+def test_spill_sink():
+    seed = np.random.RandomState(seed=6)
+    data = _forest(seed, n=5)
+    coordinates = ProjectedCoordinates(data)
+
+    expected = create_projection(HilbertProjection, data, key='hilbert', coordinates=coordinates)
+
+    with tempfile.TemporaryDirectory() as directory:
+        sink = SpillSink(directory)
+        spilled = create_projection(HilbertProjection, data, key='hilbert', coordinates=coordinates, sink=sink)
+        assert os.path.exists(spilled.path)
+
+        loaded = spilled.load()
+        assert loaded.total_order == expected.total_order
+        assert [ list(level.__dict__) for level in loaded.per_level ] == \
+            [ list(level.__dict__) for level in expected.per_level ]
+
+        # the output is the same, whether the projection was spilled or not
+        out = []
+        for projection in (expected, spilled):
+            f = io.StringIO()
+            Dataset(None, None, [], None, [ projection ]).to_json(f)
+            out.append(f.getvalue())
+        assert out[0] == out[1]
+
+        projs = create_projections_by_subtree(data, [ (HilbertProjection, 'hilbert', None, None, dict()) ],
+                coordinates=coordinates, processes=1, sink=SpillSink(directory))
+        assert projs[0].load().total_order == expected.total_order
+
+
+def test_deep_forest():
+    # deeper than the recursion limit
+    depth = sys.getrecursionlimit() + 10
+    data = leaf = [ Datum('0', '0', 0.0, 0.0, None, []) ]
+    for i in range(1, depth):
+        leaf[0].children.append(Datum(str(i), str(i), i * 1e-3, i * 1e-3, None, []))
+        leaf = leaf[0].children
+    leaf[0].children = None
+
+    projection = create_projection(HierarchicalClusteringProjection, data)
+    assert projection.total_order == [ str(i) for i in range(depth) ]
+    assert len(projection.per_level) == depth
+
+
+if __name__ == '__main__':
+    test_projected_coordinates()
+    test_projected_coordinates_validation()
+    test_array_projection()
+    test_legacy_projection()
+    test_fast_path()
+    test_global_curve()
+    test_subtree_pipeline()
+    test_subtree_pipeline_ids()
+    test_subtree_pipeline_scheduling()
+    test_pipeline_trace()
+    test_order_cache()
+    test_checkpoints()
+    test_subtree_context()
+    test_shared_forest()
+    test_spill_sink()
+    test_deep_forest()
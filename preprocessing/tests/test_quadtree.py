@@ -7,10 +7,95 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
 from util.quadtree import Quadtree, Point
 from util.plot_quadtree import plot_quadtree
-from projections.hilbert import _visit_quadtree_node as visit_hilbert
+from util.spacefillingcurves import squarified_bounds, curve_order, curve_keys, morton_order, morton_keys
+from projections.hilbert import _visit_quadtree_node as visit_hilbert, _transitions as hilbert_transitions
 from projections.morton import _visit_quadtree_node as visit_morton
 
+import numpy as np
+
+
+def _quadtree_order(xy, visit, *args):
+    bounds = squarified_bounds(xy)
+    q = Quadtree(*bounds)
+    for i, (x, y) in enumerate(xy.tolist()):
+        q.add_point(Point(x, y, i))
+
+    order = []
+    visit(order, q.root, *args)
+    return [ p.data for p in order ]
+
+
+def _point_sets():
+    seed = np.random.RandomState(seed=0)
+    yield seed.uniform(0, 100, (400, 2))
+    # clustered: many levels until the points are separated
+    yield np.concatenate((seed.uniform(0, 1, (50, 2)), 0.5 + seed.normal(0, 1e-12, (50, 2))))
+    # on the lines between the cells of a grid
+    yield np.unique(seed.randint(0, 16, (100, 2)) * 0.25, axis=0)
+    # identical points, which share the bucket of a leaf
+    yield seed.randint(0, 8, (60, 2)) * 0.5
+
+
+def test_hilbert_order():
+    for xy in _point_sets():
+        expected = _quadtree_order(xy, visit_hilbert, 0, 'A')
+        assert curve_order(xy, squarified_bounds(xy), hilbert_transitions).tolist() == expected
+
+
+def test_morton_order():
+    for xy in _point_sets():
+        expected = _quadtree_order(xy, visit_morton)
+        assert morton_order(xy, squarified_bounds(xy)).tolist() == expected
+
+        # the interleaved bits are the quadrants of each level
+        z_order = np.array([ [ (q, 0) for q in range(4) ] ])
+        for key, expected_key in zip(morton_keys(xy, squarified_bounds(xy)), curve_keys(xy, squarified_bounds(xy), z_order)):
+            assert np.array_equal(key, expected_key)
+
+
+def test_quadtree_buckets():
+    q = Quadtree(0, 0, 1, 1, max_depth=8)
+    for i, (x, y) in enumerate([ (0.25, 0.25), (0.75, 0.75), (0.25, 0.25), (0.5, 0.5), (0.5 + 1e-9, 0.5) ]):
+        q.add_point(Point(x, y, i))
+
+    # identical points share a leaf, points closer than the cells at max_depth as well
+    leaves = []
+    stack = [ q.root ]
+    while len(stack) > 0:
+        node = stack.pop()
+        if node.children is not None:
+            stack.extend(node.children)
+        elif node.datum is not None:
+            leaves.append(sorted(p.data for p in node.points))
+    assert sorted(leaves) == [ [ 0, 2 ], [ 1 ], [ 3, 4 ] ]
+    for i in range(5, 1000):
+        q.add_point(Point(0.25, 0.25, i))
+    assert [ p.data for p in q.bucket(q.first_child[0]) ] == [ 0, 2 ] + list(range(5, 1000))
+    # cells at depth 8 are not split any more
+    assert min(q.x1[i] - q.x0[i] for i in range(len(q))) == 1 / 2**8
+
+    try:
+        q.add_point(Point(float('nan'), 0, 5))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_curve_order_duplicates():
+    xy = np.array([ [0.0, 0.0], [1.0, 1.0], [0.0, 0.0], [0.5, 0.5], [1.0, 1.0] ])
+    order = curve_order(xy, squarified_bounds(xy), hilbert_transitions).tolist()
+
+    # identical points are adjacent, in input order
+    assert order == [ 0, 2, 3, 1, 4 ]
+    assert curve_order(xy[[0, 2]], squarified_bounds(xy[[0, 2]]), hilbert_transitions).tolist() == [ 0, 1 ]
+
+
 if __name__ == '__main__':
+    test_hilbert_order()
+    test_morton_order()
+    test_quadtree_buckets()
+    test_curve_order_duplicates()
+
     q = Quadtree(0, 0, 100, 100)
     for i in range(400):
         x = random.uniform(0, 100)
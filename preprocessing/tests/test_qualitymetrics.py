@@ -7,12 +7,19 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import scipy.stats as ss
+from projections.approximatequality import calculate_approximate_quality
+from projections.distancestorage import DistanceStorage
 from projections.projection import Projection
 from projections.qualitymetrics import wrapper_for_d_matrix_calculation, get_graph_from_fire_data, \
     points_ordering_to_wildfire_structure, calculate_M1_M2_score, calculate_M1, calculate_M2, \
-    calculate_metric_stress, calculate_nonmetric_stress
+    calculate_M1_M2, calculate_metric_stress, calculate_nonmetric_stress, RankMatrix, DistanceMatrix, \
+    LinearDistanceMatrix, get_knn_indices, get_knn_adjacency, get_upper_triangle, \
+    get_knn_indices_for_sweep, HaversineDistanceMatrix, calculate_distance_matrix
 from sklearn import manifold
 from sklearn.manifold import MDS
+from sklearn.isotonic import IsotonicRegression
 from sklearn.metrics import euclidean_distances
 
 
@@ -144,6 +151,194 @@ def test_using_vectors():
     plt.savefig('vector_test_dummy_projection_M2.png')
 
 
+def test_M1_M2_matches_graph_implementation():
+    seed = np.random.RandomState(seed=1)
+    points = seed.rand(50, 2) * 100
+    ordering = seed.permutation(50)
+
+    data, data_proj = points_ordering_to_wildfire_structure(points, ordering)
+    d_org = wrapper_for_d_matrix_calculation(data)
+    d_proj = wrapper_for_d_matrix_calculation(data_proj)
+
+    # for even k, the graphs pick arbitrarily among the two neighbors on a line
+    # at the same distance, while calculate_M1_M2 breaks the tie by index
+    k_vec = np.arange(1, 10, 2)
+    M1, M2 = calculate_M1_M2(points, ordering, k_vec, d_org, d_proj)
+
+    for k, m1, m2 in zip(k_vec, M1, M2):
+        G_org = get_graph_from_fire_data(data, k)
+        G_proj = get_graph_from_fire_data(data_proj, k)
+
+        assert m1 == calculate_M1(G_org, G_proj, d_org, k)
+        assert m2 == calculate_M2(G_org, G_proj, d_proj, k)
+
+
+def test_rank_matrix():
+    seed = np.random.RandomState(seed=2)
+    # integer coordinates, so that there are many tied distances
+    points = seed.randint(0, 5, (60, 2))
+    data, _ = points_ordering_to_wildfire_structure(points, range(60))
+    distances = wrapper_for_d_matrix_calculation(data).distance_matrix
+
+    expected = np.array([ss.rankdata(distances[:, i]) for i in range(60)])
+    references = seed.randint(0, 60, 1000)
+    ranked = seed.randint(0, 60, 1000)
+
+    for max_rows in (None, 1, 7):
+        ranks = RankMatrix(distances, max_rows=max_rows)
+        assert ranks.dtype == np.uint16
+        assert np.array_equal(ranks.get(references, ranked), expected[references, ranked])
+        assert np.array_equal(ranks.row(5), expected[5])
+
+
+def test_linear_distance_matrix():
+    seed = np.random.RandomState(seed=3)
+    ordering = seed.permutation(40)
+    points_proj = np.column_stack((ordering, np.zeros(40)))
+
+    d_linear = LinearDistanceMatrix(ordering)
+    d_proj = DistanceMatrix.from_array(points_proj)
+
+    assert np.array_equal(d_linear.distance_matrix[0:40, 0:40], d_proj.distance_matrix)
+    assert d_linear.distance_matrix.max() == np.max(d_proj.distance_matrix)
+
+    references = seed.randint(0, 40, 500)
+    ranked = seed.randint(0, 40, 500)
+    assert np.array_equal(d_linear.get_ranks_by_matrix_index(references, ranked),
+                          d_proj.get_ranks_by_matrix_index(references, ranked))
+
+    # for odd k, the k-1 nearest neighbors on a line are unique
+    for k in (1, 3, 5, 7):
+        adjacency_linear = get_knn_adjacency(d_linear.get_knn_indices(k))
+        adjacency_proj = get_knn_adjacency(get_knn_indices(points_proj, k))
+        assert (adjacency_linear != adjacency_proj).nnz == 0
+
+
+def test_knn_sweep():
+    seed = np.random.RandomState(seed=4)
+    ordering = seed.permutation(40)
+    points = seed.rand(40, 2) * 100
+    points_proj = np.column_stack((ordering, np.zeros(40)))
+    k_max = 12
+
+    # the canonical order breaks ties by index, so the analytic and the general
+    # neighborhoods agree for every k, also for even k
+    knn_org, knn_linear = get_knn_indices_for_sweep(points, points_proj, None, LinearDistanceMatrix(ordering), k_max)
+    _, knn_proj = get_knn_indices_for_sweep(points, points_proj, None, DistanceMatrix.from_array(points_proj), k_max)
+    assert np.array_equal(knn_linear, knn_proj)
+
+    for k in range(1, k_max + 1):
+        assert np.array_equal(knn_org[:, :k - 1], get_knn_indices(points, k))
+        assert np.array_equal(knn_linear[:, :k - 1], get_knn_indices(points_proj, k))
+
+    k_vec = np.arange(1, k_max + 1)
+    M1_linear, M2_linear = calculate_M1_M2(points, ordering, k_vec)
+    M1_proj, M2_proj = calculate_M1_M2(points, ordering, k_vec, DistanceMatrix.from_array(points),
+                                       DistanceMatrix.from_array(points_proj))
+    assert np.allclose(M1_linear, M1_proj)
+    assert np.allclose(M2_linear, M2_proj)
+
+
+def test_nonmetric_stress_matches_isotonic_regression():
+    seed = np.random.RandomState(seed=8)
+    ordering = seed.permutation(80)
+    d_proj = np.abs(ordering[:, np.newaxis] - ordering[np.newaxis, :]).astype(float)
+
+    # random and integer coordinates, the latter with many tied distances
+    for points in (seed.rand(80, 2), seed.randint(0, 5, (80, 2))):
+        d_org = euclidean_distances(points)
+
+        org_vec = get_upper_triangle(d_org)
+        proj_vec = get_upper_triangle(d_proj)
+        disparities = IsotonicRegression(increasing=True).fit(org_vec, proj_vec).predict(org_vec)
+        expected = np.sqrt(np.sum((proj_vec - disparities) ** 2) / np.sum(proj_vec ** 2))
+
+        assert np.isclose(calculate_nonmetric_stress(d_org, d_proj), expected, rtol=1e-12)
+        assert np.isclose(calculate_nonmetric_stress(d_org, LinearDistanceMatrix(ordering).distance_matrix),
+                          expected, rtol=1e-12)
+
+        # all 3160 pairs fit into max_pairs, so it is exact
+        assert calculate_nonmetric_stress(d_org, d_proj, max_pairs=5000) == calculate_nonmetric_stress(d_org, d_proj)
+        assert abs(calculate_nonmetric_stress(d_org, d_proj, max_pairs=2000) - expected) < 0.05
+
+
+def test_haversine_distance_matrix():
+    seed = np.random.RandomState(seed=9)
+    # [lat, lng] around Australia, plus a duplicate location
+    points = np.column_stack((seed.uniform(-40, -10, 60), seed.uniform(115, 150, 60)))
+    points[1] = points[0]
+
+    d = HaversineDistanceMatrix(points)
+    dense = d.distance_matrix[0:60, 0:60]
+
+    df = pd.DataFrame(dict(x=points[:, 1], y=points[:, 0]))
+    assert np.allclose(dense, calculate_distance_matrix(df, dist_metric='haversine'), rtol=1e-6, atol=1e-3)
+    assert d.distance_matrix.max() == np.max(dense)
+
+    references = seed.randint(0, 60, 500)
+    ranked = seed.randint(0, 60, 500)
+    expected = np.array([ ss.rankdata(dense[r])[c] for r, c in zip(references, ranked) ])
+    assert np.array_equal(d.get_ranks_by_matrix_index(references, ranked), expected)
+
+    # canonical order: by distance, then by index
+    knn = d.get_knn_indices(8)
+    for i in range(60):
+        order = np.lexsort((np.arange(60), dense[i]))
+        assert np.array_equal(knn[i], order[order != i][:7])
+
+    proj = Projection()
+    haversine = proj._calculate_quality_metrics(points, seed.permutation(60), 5, True, distance_metric='haversine')
+    assert 0 <= haversine['M1'] <= 1 and 0 <= haversine['M2'] <= 1
+
+
+def test_distance_storage():
+    seed = np.random.RandomState(seed=5)
+    points = seed.rand(50, 2) * 100
+    dense = DistanceMatrix.from_array(points)
+
+    references = seed.randint(0, 50, 500)
+    ranked = seed.randint(0, 50, 500)
+
+    for storage in (DistanceStorage(layout='condensed'),
+                    DistanceStorage(layout='condensed', memmap_threshold=10),
+                    DistanceStorage(layout='dense', dtype=np.float32, memmap_threshold=10)):
+        d = DistanceMatrix.from_array(points, storage=storage)
+        rtol = 1e-6 if storage.dtype == np.float32 else 1e-12
+
+        assert np.allclose(d.distance_matrix[0:50, 0:50], dense.distance_matrix, rtol=rtol)
+        assert np.allclose(get_upper_triangle(d.distance_matrix), get_upper_triangle(dense.distance_matrix), rtol=rtol)
+        assert np.isclose(calculate_metric_stress(d.distance_matrix / d.distance_matrix.max(), dense.distance_matrix),
+                          calculate_metric_stress(dense.distance_matrix / dense.distance_matrix.max(), dense.distance_matrix))
+        assert np.isclose(calculate_metric_stress(d.distance_matrix, dense.distance_matrix,
+                                                  scale_original=d.distance_matrix.max()),
+                          calculate_metric_stress(dense.distance_matrix / dense.distance_matrix.max(), dense.distance_matrix))
+        if storage.dtype == np.float64:
+            assert np.array_equal(d.get_ranks_by_matrix_index(references, ranked),
+                                  dense.get_ranks_by_matrix_index(references, ranked))
+
+
+def test_approximate_quality():
+    seed = np.random.RandomState(seed=6)
+    points = seed.rand(300, 2) * 100
+    ordering = np.argsort(np.argsort(points[:, 0]))
+
+    exact = Projection()._calculate_quality_metrics(points, ordering, 5, False)
+    assert 'quality' not in Projection()._calculate_quality_metrics(points, ordering, 5, False, mode='approx')
+
+    # all nodes sampled: M1 is exact, M2 is always exact
+    approx = calculate_approximate_quality(points, ordering, [5], n_nodes=300)
+    assert np.isclose(approx['M1'], exact['M1'])
+    assert np.isclose(approx['M1_ci'][0], approx['M1_ci'][1])
+    assert np.isclose(approx['M2'], exact['M2'])
+
+    approx = calculate_approximate_quality(points, ordering, [5], n_nodes=50, n_pairs=5000)
+    assert approx == calculate_approximate_quality(points, ordering, [5], n_nodes=50, n_pairs=5000)
+    for metric in ('M1', 'metric_stress', 'nonmetric_stress'):
+        low, high = approx[F'{metric}_ci']
+        assert low <= approx[metric] <= high
+        assert abs(approx[metric] - exact[metric]) < 0.05
+
+
 def test_stress():
     proj = Projection()
     x_arr, y_arr = np.meshgrid(np.arange(4), np.arange(4))
@@ -195,6 +390,20 @@ def test_stress2():
     assert metric_stress_norm < 1
 
 
+def test_metric_stress_blocks():
+    seed = np.random.RandomState(seed=4)
+    d_org = seed.rand(30, 30)
+    d_proj = seed.rand(30, 30)
+
+    numerator = sum((d_proj[i, j] - d_org[i, j]) ** 2 for i in range(30) for j in range(i))
+    denominator = sum(d_proj[i, j] ** 2 for i in range(30) for j in range(i))
+
+    for block_size in (None, 1, 7, 30):
+        assert np.isclose(calculate_metric_stress(d_org, d_proj, norm=False, block_size=block_size), numerator)
+        assert np.isclose(calculate_metric_stress(d_org, d_proj, block_size=block_size),
+                          np.sqrt(numerator / denominator))
+
+
 def test_nonmetric_stress_runthrough():
     proj = Projection()
     n = 10
@@ -261,7 +470,16 @@ def test_compare_non_metric_to_scikit():
 if __name__ == '__main__':
     test_using_wildfire_data()
     test_using_vectors()
+    test_M1_M2_matches_graph_implementation()
+    test_rank_matrix()
+    test_linear_distance_matrix()
+    test_knn_sweep()
+    test_nonmetric_stress_matches_isotonic_regression()
+    test_haversine_distance_matrix()
+    test_distance_storage()
+    test_approximate_quality()
     test_stress()
     test_stress2()
+    test_metric_stress_blocks()
     test_nonmetric_stress_runthrough()
     test_compare_non_metric_to_scikit()
@@ -1,97 +1,205 @@
 import math
+from array import array
 from functools import namedtuple
 
 Point = namedtuple('Point', ('x', 'y', 'data'))
 
 
-class Node:
-    def __init__(self, x0, y0, x1, y1, datum):
-        self.x0 = x0
-        self.x1 = x1
-        self.y0 = y0
-        self.y1 = y1
-
-        self.datum = datum
-        self.children = None
+# default for the maximum depth: deeper cells (below 2^-64 of the root) are not split any more
+MAX_DEPTH = 64
 
 
 class Quadtree:
-    def __init__(self, x0, y0, x1, y1):
-        self.root = Node(x0, y0, x1, y1, None)
+    '''
+    Point quadtree over the rectangle `(x0, y0, x1, y1)`, in which each leaf
+    holds one point, or a bucket of points that cannot be separated: points
+    with identical coordinates, and points in a cell at `max_depth`.
 
-    def add_point(self, p):
-        if math.isnan(p.x) or math.isnan(p.y) or math.isinf(p.x) or math.isinf(p.y):
-            import sys, json
-            sys.stderr.write(F'Invalid coordinates for {p}\n')
+    The nodes are stored as arrays, indexed by node number (the root is 0):
+    the bounds `x0`, `y0`, `x1` and `y1`, `first_child` (the four children
+    of a node are consecutive, -1 for leaves), `head` and `last_point` (the
+    first and last point of the bucket of a leaf, -1 if it is empty). The
+    points of a bucket are linked by `next_point`. `root` and `Node` present
+    them as node objects for the visitors of the curves and `plot_quadtree`.
 
-            json.dump(p.data, sys.stderr, indent=2, default=lambda x: x.__dict__)
-            sys.exit(1)
+    @param max_depth    Depth at which cells are no longer split.
+    '''
+    def __init__(self, x0, y0, x1, y1, max_depth=MAX_DEPTH):
+        self.max_depth = max_depth
 
+        self.x0 = array('d', [ x0 ])
+        self.y0 = array('d', [ y0 ])
+        self.x1 = array('d', [ x1 ])
+        self.y1 = array('d', [ y1 ])
+        self.first_child = array('q', [ -1 ])
+        self.head = array('q', [ -1 ])
+        self.last_point = array('q', [ -1 ])
 
-        try:
-            _recursive_add_point(self.root, p)
-        except RecursionError:
-            import sys, json
-            sys.stderr.write(F'Recursion Error @ {p}\n')
-            sys.stderr.write(F'  {p.data.name, p.data.lat, p.data.lng}\n')
-            sys.stderr.write(F'  Root {self.root.x0} {self.root.y0} {self.root.x1} {self.root.y1}\n')
+        self.points = []
+        self.next_point = array('q')
 
-            sys.stderr.write('Tree:\n')
-            def rec(node):
-                if node.datum is not None:
-                    sys.stderr.write(F'  {node.datum.data.name}, {node.datum.data.lat}, {node.datum.data.lng}, {node.datum.x}, {node.datum.y}\n')
-                elif node.children is not None:
-                    for child in node.children:
-                        rec(child)
-            rec(self.root)
 
-            sys.exit(1)
+    @property
+    def root(self):
+        return Node(self, 0)
 
 
+    def __len__(self):
+        '''
+        Number of nodes.
+        '''
+        return len(self.first_child)
 
-def _recursive_add_point(node, point):
-    if node.children is None and node.datum is None:
-        # empty leaf node
-        node.datum = point
 
-    elif node.children is None:
-        # occupied leaf node
-        x0 = node.x0
-        x1 = node.x1
-        y0 = node.y0
-        y1 = node.y1
-        w = x1 - x0
-        h = y1 - y0
+    def add_point(self, p):
+        '''
+        @raises ValueError  if the coordinates of `p` are not finite.
+        '''
+        if math.isnan(p.x) or math.isnan(p.y) or math.isinf(p.x) or math.isinf(p.y):
+            raise ValueError(F'Invalid coordinates for {p}')
+
+        node, depth = 0, 0
+        while self.first_child[node] >= 0:
+            node = self.first_child[node] + self._quadrant(node, p)
+            depth += 1
 
-        # split
-        node.children = [
-            Node(x0, y0, x0 + w/2, y0 + h/2, None),
-            Node(x0 + w/2, y0, x1, y0 + h/2, None),
-            Node(x0, y0 + h/2, x0 + w/2, y1, None),
-            Node(x0 + w/2, y0 + h/2, x1, y1, None)
-            ]
-        oldchild = node.datum
-        node.datum = None
-
-        # add both points
-        _recursive_add_point(node, oldchild)
-        _recursive_add_point(node, point)
-
-    else:
-        # non-leaf node
+        while True:
+            head = self.head[node]
+            if head < 0:
+                self._push(node, p)
+                return
+
+            other = self.points[head]
+            if depth >= self.max_depth or (other.x == p.x and other.y == p.y):
+                self._push(node, p)
+                return
+
+            # occupied leaf: split it, move its bucket to the child, and continue there with p
+            first = self._split(node)
+            child = first + self._quadrant(node, other)
+            self.head[child], self.last_point[child] = head, self.last_point[node]
+            self.head[node], self.last_point[node] = -1, -1
+
+            node = first + self._quadrant(node, p)
+            depth += 1
+
+
+    def _quadrant(self, node, p):
         #
         # 0 | 1
         # -----
         # 2 | 3
         #
-        xm = (node.x1 + node.x0) / 2
-        ym = (node.y1 + node.y0) / 2
+        xm = (self.x1[node] + self.x0[node]) / 2
+        ym = (self.y1[node] + self.y0[node]) / 2
 
         idx = 0
-        if point.x >= xm:
+        if p.x >= xm:
             idx += 1
-        if point.y >= ym:
+        if p.y >= ym:
             idx += 2
+        return idx
+
+
+    def _split(self, node):
+        x0 = self.x0[node]
+        x1 = self.x1[node]
+        y0 = self.y0[node]
+        y1 = self.y1[node]
+        w = x1 - x0
+        h = y1 - y0
+
+        first = len(self.first_child)
+        self.first_child[node] = first
+        for cx0, cy0, cx1, cy1 in (
+                (x0, y0, x0 + w/2, y0 + h/2),
+                (x0 + w/2, y0, x1, y0 + h/2),
+                (x0, y0 + h/2, x0 + w/2, y1),
+                (x0 + w/2, y0 + h/2, x1, y1)):
+            self.x0.append(cx0)
+            self.y0.append(cy0)
+            self.x1.append(cx1)
+            self.y1.append(cy1)
+            self.first_child.append(-1)
+            self.head.append(-1)
+            self.last_point.append(-1)
+
+        return first
+
+
+    def _push(self, node, p):
+        # appends p to the bucket of a leaf
+        self.points.append(p)
+        self.next_point.append(-1)
+        i = len(self.points) - 1
+
+        if self.head[node] < 0:
+            self.head[node] = i
+        else:
+            self.next_point[self.last_point[node]] = i
+        self.last_point[node] = i
+
+
+    def bucket(self, node):
+        '''
+        The points of a leaf.
+        '''
+        points = []
+        i = self.head[node]
+        while i >= 0:
+            points.append(self.points[i])
+            i = self.next_point[i]
+        return points
+
+
+class Node:
+    '''
+    A node of a `Quadtree`, with its bounds, its `children` (None for a
+    leaf) and its `datum`: the point of a leaf, or the first point of a
+    bucket (see `points` for all of them).
+    '''
+    __slots__ = ('tree', 'index')
+
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+
+    @property
+    def x0(self):
+        return self.tree.x0[self.index]
+
+
+    @property
+    def y0(self):
+        return self.tree.y0[self.index]
+
+
+    @property
+    def x1(self):
+        return self.tree.x1[self.index]
+
+
+    @property
+    def y1(self):
+        return self.tree.y1[self.index]
+
+
+    @property
+    def children(self):
+        first = self.tree.first_child[self.index]
+        if first < 0:
+            return None
+        return [ Node(self.tree, first + i) for i in range(4) ]
+
+
+    @property
+    def datum(self):
+        head = self.tree.head[self.index]
+        return self.tree.points[head] if head >= 0 else None
 
-        _recursive_add_point(node.children[idx], point)
 
+    @property
+    def points(self):
+        return self.tree.bucket(self.index)
@@ -0,0 +1,208 @@
+import numpy as np
+
+
+# levels of the curve in each word of a key, 2 bits per level
+LEVELS_PER_WORD = 32
+
+# refinement stops after this many words; the points that are still tied then keep their input order
+MAX_WORDS = 64
+
+
+def squarified_bounds(xy):
+    '''
+    `(x0, y0, x1, y1)` of the bounding box of the points `xy`, grown to a
+    square around its center.
+    '''
+    min_x, min_y = (float(v) for v in np.min(xy, axis=0))
+    max_x, max_y = (float(v) for v in np.max(xy, axis=0))
+
+    dx = max_x - min_x
+    dy = max_y - min_y
+    if dx > dy:
+        delta = dx - dy
+        min_y -= delta/2
+        max_y += delta/2
+    else:
+        delta = dy - dx
+        min_x -= delta/2
+        max_x += delta/2
+
+    return min_x, min_y, max_x, max_y
+
+
+def curve_order(xy, bounds, transitions, initial_state=0):
+    '''
+    Order of the points `xy` along a space-filling curve through the square
+    `bounds`, as a permutation of their indices: the order in which a
+    traversal of a `Quadtree` of the points visits them.
+
+    The key of a point is the sequence of its positions on the curve at each
+    level, computed for all points at once. As in the quadtree, a cell is
+    split at `(x0 + x1) / 2` (points on the line go to the upper half), and
+    its children span `x0 + (x1 - x0) / 2`, with the same floating point
+    operations, so that the keys match the quadtree exactly. Keys are
+    refined by `LEVELS_PER_WORD` levels at a time, and only for the points
+    that share their key with others so far.
+
+    Points with identical coordinates are in their input order.
+
+    The order is computed from `curve_ranks`.
+
+    @param xy           numpy.ndarray of shape (n, 2).
+
+    @param bounds       `(x0, y0, x1, y1)`, see `squarified_bounds`.
+
+    @param transitions  numpy.ndarray of shape (states, 4, 2) that defines the
+                        curve: for a state and a quadrant of a cell (0 | 1
+                        below 2 | 3 in y, as the children of a quadtree
+                        node), the position of the quadrant on the curve and
+                        the state of the quadrant.
+    '''
+    return np.argsort(curve_ranks(xy, bounds, transitions, initial_state), kind='stable')
+
+
+def curve_ranks(xy, bounds, transitions, initial_state=0):
+    '''
+    The position of each of the points `xy` on the curve, see `curve_order`.
+    Identical points have the same rank, so ranks can be computed once for
+    many points and the order of any subset is the (stable) order of its
+    ranks.
+    '''
+    return _ranks_by_keys(xy, lambda unique: curve_keys(unique, bounds, transitions, initial_state))
+
+
+def morton_order(xy, bounds):
+    '''
+    Order of the points `xy` along the Morton (Z-order) curve through the
+    square `bounds`, see `curve_order` and `morton_keys`.
+    '''
+    return np.argsort(morton_ranks(xy, bounds), kind='stable')
+
+
+def morton_ranks(xy, bounds):
+    '''
+    The position of each of the points `xy` on the Morton curve, see `curve_ranks`.
+    '''
+    return _ranks_by_keys(xy, lambda unique: morton_keys(unique, bounds))
+
+
+def _ranks_by_keys(xy, keys):
+    xy = np.asarray(xy, dtype=float)
+
+    # identical points cannot be separated: key the distinct ones
+    unique, inverse = np.unique(xy, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if len(unique) <= 1:
+        return np.zeros(len(xy), dtype=np.int64)
+    words = keys(unique)
+
+    rank = np.empty(len(unique), dtype=np.int64)
+    rank[np.lexsort(words[::-1])] = np.arange(len(unique))
+    return rank[inverse]
+
+
+def curve_keys(xy, bounds, transitions, initial_state=0):
+    '''
+    Keys of the points `xy` on the curve of `transitions`, see `curve_order`,
+    as a list of numpy.ndarray of `numpy.uint64` words, the most significant
+    first. The lexicographic order of the keys is the order of the points.
+
+    The keys are only as long as needed to separate all points: words after
+    the one that separates a point from all others are 0.
+    '''
+    transitions = np.asarray(transitions, dtype=np.int64)
+
+    def _word(x, y, x0, y0, x1, y1, state):
+        word = np.zeros(len(x), dtype=np.uint64)
+        for _ in range(LEVELS_PER_WORD):
+            right = x >= (x1 + x0) / 2
+            top = y >= (y1 + y0) / 2
+
+            digit, state = transitions[state, right + 2 * top].T
+            word = (word << np.uint64(2)) | digit.astype(np.uint64)
+
+            x0, x1 = _bisect(right, x0, x1)
+            y0, y1 = _bisect(top, y0, y1)
+
+        return word, (x, y, x0, y0, x1, y1, state)
+
+    return _refine(xy, bounds, _word, np.full(len(xy), initial_state, dtype=np.int64))
+
+
+def morton_keys(xy, bounds):
+    '''
+    Keys of the points `xy` on the Morton curve, as `curve_keys`.
+
+    Each coordinate is quantized to `LEVELS_PER_WORD` bits at a time by the
+    bisection of the quadtree, and the bits of x and y are interleaved (y in
+    the upper bit of each level, as the quadrants of a quadtree node).
+    '''
+    def _word(x, y, x0, y0, x1, y1):
+        qx, x0, x1 = _quantize(x, x0, x1)
+        qy, y0, y1 = _quantize(y, y0, y1)
+        return _spread(qx) | (_spread(qy) << np.uint64(1)), (x, y, x0, y0, x1, y1)
+
+    return _refine(xy, bounds, _word)
+
+
+def _quantize(v, v0, v1):
+    # LEVELS_PER_WORD bits of the position of v in [v0, v1], the most significant first
+    q = np.zeros(len(v), dtype=np.uint64)
+    for _ in range(LEVELS_PER_WORD):
+        upper = v >= (v1 + v0) / 2
+        q = (q << np.uint64(1)) | upper.astype(np.uint64)
+        v0, v1 = _bisect(upper, v0, v1)
+    return q, v0, v1
+
+
+def _bisect(upper, v0, v1):
+    # the half of [v0, v1] of each point, with the bounds of the children of a quadtree node
+    mid = v0 + (v1 - v0) / 2
+    return np.where(upper, mid, v0), np.where(upper, v1, mid)
+
+
+# masks to spread the 32 lower bits of a uint64 to the even bits
+_SPREAD = [ (16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+            (2, 0x3333333333333333), (1, 0x5555555555555555) ]
+
+
+def _spread(q):
+    q = q & np.uint64(0xFFFFFFFF)
+    for shift, mask in _SPREAD:
+        q = (q | (q << np.uint64(shift))) & np.uint64(mask)
+    return q
+
+
+def _refine(xy, bounds, word, *state):
+    '''
+    Keys of the points `xy`, one `word(x, y, x0, y0, x1, y1, *state)` (which
+    returns the word and the new arguments) at a time, while points share
+    their key with others.
+    '''
+    n = len(xy)
+    active = np.arange(n)
+    arrays = (xy[:, 0].astype(float), xy[:, 1].astype(float),
+            np.full(n, float(bounds[0])), np.full(n, float(bounds[1])),
+            np.full(n, float(bounds[2])), np.full(n, float(bounds[3]))) + state
+
+    words = []
+    while len(active) > 1 and len(words) < MAX_WORDS:
+        w, arrays = word(*arrays)
+        full = np.zeros(n, dtype=np.uint64)
+        full[active] = w
+        words.append(full)
+
+        # continue with the points whose key so far is not unique
+        keys = [ w[active] for w in words ]
+        order = np.lexsort(keys[::-1])
+        same = np.ones(len(active) - 1, dtype=bool)
+        for key in keys:
+            same &= key[order[1:]] == key[order[:-1]]
+        tied = np.zeros(len(active), dtype=bool)
+        tied[order[1:][same]] = True
+        tied[order[:-1][same]] = True
+
+        active = active[tied]
+        arrays = tuple(a[tied] for a in arrays)
+
+    return words
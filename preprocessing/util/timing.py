@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Tracer:
+    '''
+    Records timing spans: the wall time and the CPU time of the current
+    process for a named stage, together with arbitrary `args` (e.g., the
+    projection and the size of the subtree).
+
+    Spans recorded in worker processes (by their own `Tracer`) are merged
+    into the main one with `extend`. Timestamps are from `time.perf_counter`,
+    which uses the same clock in all processes of a machine.
+
+    @param enabled  If False, `span` records nothing, so that the stages can
+                    always be wrapped.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.args = dict()
+
+
+    def bind(self, **args):
+        '''
+        A tracer that adds `args` to all its spans and records them in this one.
+        '''
+        bound = Tracer(self.enabled)
+        bound.origin = self.origin
+        bound.spans = self.spans
+        bound.args = dict(self.args, **args)
+        return bound
+
+
+    @contextmanager
+    def span(self, name, **args):
+        '''
+        Context manager that records a span `name` for the code it wraps.
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.spans.append(dict(name=name, start=start, wall=time.perf_counter() - start,
+                    cpu=time.process_time() - cpu_start, pid=os.getpid(), tid=threading.get_ident(),
+                    args=dict(self.args, **args)))
+
+
+    def extend(self, spans):
+        if self.enabled:
+            self.spans.extend(spans)
+
+
+    def report(self):
+        '''
+        dict with all spans (`start` in seconds since this tracer was
+        created), and the total wall and CPU time of each stage.
+        '''
+        totals = defaultdict(lambda: dict(count=0, wall=0.0, cpu=0.0))
+        for span in self.spans:
+            total = totals[span['name']]
+            total['count'] += 1
+            total['wall'] += span['wall']
+            total['cpu'] += span['cpu']
+
+        spans = [ dict(span, start=span['start'] - self.origin) for span in sorted(self.spans, key=lambda s: s['start']) ]
+        return dict(stages=dict(totals), spans=spans)
+
+
+    def chrome_trace(self):
+        '''
+        The spans as a Chrome trace (Trace Event Format, e.g., for
+        chrome://tracing or Perfetto), with one lane per process.
+        '''
+        events = []
+        for pid in sorted(set(span['pid'] for span in self.spans)):
+            name = 'main' if pid == os.getpid() else F'worker {pid}'
+            events.append(dict(name='thread_name', ph='M', pid=0, tid=pid, args=dict(name=name)))
+
+        for span in sorted(self.spans, key=lambda s: s['start']):
+            events.append(dict(name=span['name'], cat='preprocessing', ph='X', pid=0, tid=span['pid'],
+                    ts=(span['start'] - self.origin) * 1e6, dur=span['wall'] * 1e6,
+                    args=dict(span['args'], cpu=span['cpu'])))
+
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+
+    def write(self, prefix):
+        '''
+        Write `<prefix>.json` with the `report` and `<prefix>.trace.json` with
+        the `chrome_trace`.
+        '''
+        with open(F'{prefix}.json', 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        with open(F'{prefix}.trace.json', 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+
+# for stages that are always wrapped in spans, but not traced
+NULL_TRACER = Tracer(enabled=False)
@@ -10,22 +10,25 @@ import math
 import logging
 from datetime import datetime, timedelta
 from functools import namedtuple, partial
-from itertools import repeat
 import brotli
-from multiprocessing import Pool
 
 from datatypes import TimeseriesSpecification, \
         Datum, \
         Projection, \
         Dataset
 
-from projections.projection import create_projection
+from projections.pipeline import create_projections_by_subtree
+from projections.ordercache import OrderCache
+from projections.checkpoints import ProjectionCheckpoints
+from projections.sinks import SpillSink
+from projections.distancestorage import DistanceStorage
 from projections.hilbert import HilbertProjection
 from projections.morton import MortonProjection
 from projections.hierarchicalclustering import HierarchicalClusteringProjection
 from projections.dynamictimewarping import DynamicTimeWarpingProjection
 from projections.firstoccurrence import FirstOccurrenceProjection
 from projections.umap import UMAPProjection
+from util.timing import Tracer, NULL_TRACER
 
 
 logging.basicConfig(format='%(asctime)s %(levelname)8s  %(message)s',
@@ -145,14 +148,7 @@ def create_metadata():
 def extract_timeseries(datum):
     return list(map(lambda x: x if x is not None and not math.isnan(x) else 0, datum.data))
 
-def _do_create(arg):
-    data, (p, key, name, description, kwargs) = arg
-    proj = create_projection(p, data, key=key, name=name, description=description, k_max=8, k_vec=False, **kwargs)
-    logging.info('  Created projection %s.', key)
-    return proj
-
-
-def create_projections(data, flightdata=None, tslen=1):
+def create_projections(data, flightdata=None, tslen=1, tracer=NULL_TRACER, cache=None, checkpoints=None):
     logging.info('Creating dataset projections.')
 
     projections = []
@@ -280,8 +276,12 @@ def create_projections(data, flightdata=None, tslen=1):
 
 
 
-    args = zip(repeat(data), projections)
-    projs = Pool().map(_do_create, args)
+    # one task per projection and subtree, the most expensive first
+    projs = create_projections_by_subtree(data, projections, k_max=8, k_vec=True, tracer=tracer, cache=cache,
+            # large levels: only keep the upper triangle, and on disk beyond 20000 cells
+            distance_storage=DistanceStorage(layout='condensed', memmap_threshold=20000),
+            # many levels: keep the finished level orders on disk until the output is written
+            sink=SpillSink(), checkpoints=checkpoints)
 
     return projs
 
@@ -291,14 +291,30 @@ if __name__ == '__main__':
     parser.add_argument('input', metavar='<input.json.br>', help='Wildfire input data', type=argparse.FileType('rb'))
     parser.add_argument('out', metavar='<output file>', help='Output .json.br filename', type=argparse.FileType('wb'))
 
+    parser.add_argument('--cache', metavar='<directory>', help='Reuse the orders of unchanged subtrees from '
+            'earlier runs, and add new ones to this directory')
+    parser.add_argument('--checkpoints', metavar='<directory>', help='Write each finished projection to this '
+            'directory')
+    parser.add_argument('--resume', action='store_true', help='Load the projections that an earlier run wrote to '
+            'the --checkpoints directory instead of computing them again')
+    parser.add_argument('--trace', metavar='<prefix>', help='Write timings of all stages to <prefix>.json and '
+            'a Chrome trace to <prefix>.trace.json')
+
     parsed = parser.parse_args(sys.argv[1:])
+    if parsed.resume and parsed.checkpoints is None:
+        parser.error('--resume requires --checkpoints')
+    tracer = Tracer(enabled=parsed.trace is not None)
 
     timeseries, data = load_json(parsed.input)
 
     if check_no_duplicate_coordinates(data):
         sys.exit(1)
 
-    projs = create_projections(data, tslen=len(timeseries.series))
+    with tracer.span('create_projections'):
+        projs = create_projections(data, tslen=len(timeseries.series), tracer=tracer,
+                cache=OrderCache(parsed.cache) if parsed.cache is not None else None,
+                checkpoints=ProjectionCheckpoints(parsed.checkpoints, resume=parsed.resume)
+                    if parsed.checkpoints is not None else None)
 
     meta = create_metadata()
 
@@ -311,16 +327,23 @@ if __name__ == '__main__':
             )
 
     logging.info('Compressing final dataset')
-    bytesio = io.StringIO()
-    dataset.to_json(bytesio)
-    json_data = bytesio.getvalue().encode('utf-8')
+    with tracer.span('to_json'):
+        bytesio = io.StringIO()
+        dataset.to_json(bytesio)
+        json_data = bytesio.getvalue().encode('utf-8')
     sz1 = len(json_data)
     logging.info('  Created JSON (~%.1fMiB)', sz1/1048576)
-    compressed = brotli.compress(json_data, brotli.MODE_TEXT)
+    with tracer.span('compress'):
+        compressed = brotli.compress(json_data, brotli.MODE_TEXT)
     sz2 = len(compressed)
     logging.info('  Compressed to ~%.1fMiB (%.1fx)', sz2/1048576, sz1/sz2)
 
     logging.info('Writing final dataset to %s', parsed.out.name)
-    parsed.out.write(compressed)
+    with tracer.span('write'):
+        parsed.out.write(compressed)
+
+    if parsed.trace is not None:
+        tracer.write(parsed.trace)
+        logging.info('Wrote timings to %s.json and %s.trace.json', parsed.trace, parsed.trace)
 
     logging.info('Done processing Corona dataset')